@@ -0,0 +1,333 @@
+"""
+マーブル模様ジェネレーターのベンチマーク
+
+解像度・パレットの色数・MARBLE_VARIANTS の組み合わせごとに create_enhanced_marble の時間を測り、
+実時間・ピークメモリ（RSS）・1秒あたりの画素数を JSON に書き出す。
+既定では小さい解像度（QUICK_RESOLUTIONS）だけを測り、リポジトリにある benchmark_baseline.json と比べて、
+遅くなった（メモリが増えた）組み合わせを報告して終了コード 1 で終わる。
+実時間は繰り返しの中央値で、全組み合わせの比の幾何平均と、組み合わせごとの比（ばらつきに応じて許容範囲を広げる）
+の両方で判定する（compare_to_baseline を参照）。
+ベースラインと環境が違うときは、時間の差は報告するだけで失敗にしない。
+--full ですべての解像度を測る（1920x1080 まで含むので時間がかかる）。
+--encode では生成ではなく、カタログの保存形式（IMAGE_FORMATS）ごとのエンコードの時間とバイト数を測る。
+
+    python benchmark_marble.py                       # benchmark_baseline.json と比べる
+    python benchmark_marble.py --output before.json --no-baseline
+    （変更を加える）
+    python benchmark_marble.py --output after.json --baseline before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy
+
+from marble_generator import (
+    create_enhanced_marble, derive_seed, COLOR_PALETTES, VIBRANT_COLORS, MARBLE_VARIANTS, GENERATOR_VERSION,
+    IMAGE_FORMATS, THUMBNAIL_REDUCE, _encode_image
+)
+
+try:
+    import resource
+except ImportError:  # Windows では RSS を測らない
+    resource = None
+
+# 測る解像度（幅, 高さ）
+RESOLUTIONS = [(200, 150), (400, 300), (800, 600), (1280, 720), (1920, 1080)]
+
+# 既定で測る解像度（--full のときは RESOLUTIONS）
+QUICK_RESOLUTIONS = [(200, 150), (400, 300)]
+
+# ベンチマークの形式（結果の項目や測り方を変えたら上げる）
+# 2: 実時間を最小値から中央値に変え、ばらつき（wall_noise）を記録する
+BENCHMARK_VERSION = 2
+
+# 実時間の許容する増加を、繰り返しのばらつき（wall_noise）の何倍まで広げるか
+NOISE_FACTOR = 3
+
+# 既定で比べるベースライン（QUICK_RESOLUTIONS の結果。測った環境は "environment" に記録してある）
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# ベースラインと比べるときに、違っていれば注意を出す環境の項目
+ENVIRONMENT_KEYS = ("python", "numpy", "scipy", "platform", "cpu_count")
+
+
+def palettes_by_size():
+    """
+    COLOR_PALETTES と VIBRANT_COLORS から、色数ごとに代表のパレットを1つずつ選ぶ
+    シミュレーションの時間は色の値ではなく色数で決まるので、同じ色数のパレットは1つだけ測る。
+    """
+    palettes = {}
+    for name, colors in {**COLOR_PALETTES, **VIBRANT_COLORS}.items():
+        palettes.setdefault(len(colors), (name, colors))
+    return dict(sorted(palettes.items()))
+
+
+def benchmark_cases(resolutions=None, variants=None):
+    """解像度・色数・バリエーションの全組み合わせを並べる"""
+    if resolutions is None:
+        resolutions = RESOLUTIONS
+    if variants is None:
+        variants = list(MARBLE_VARIANTS)
+    cases = []
+    for width, height in resolutions:
+        for num_colors, (palette_name, colors) in palettes_by_size().items():
+            for variant_name in variants:
+                cases.append({
+                    "key": f"{width}x{height}/{num_colors}colors/{variant_name}",
+                    "width": width,
+                    "height": height,
+                    "num_colors": num_colors,
+                    "palette": palette_name,
+                    "variant": variant_name,
+                })
+    return cases
+
+
+def _peak_rss_bytes():
+    """このプロセスのこれまでのピーク RSS（測れない環境では None）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux はキロバイト、macOS はバイト単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_case(case, repeat):
+    """
+    1つの組み合わせを repeat 回生成して測る（新しいプロセスの中で呼ぶ）
+    ピーク RSS はプロセス全体の最大値なので、組み合わせごとにプロセスを分けて前の結果が混ざらないようにする。
+    """
+    colors = {**COLOR_PALETTES, **VIBRANT_COLORS}[case["palette"]]
+    params = MARBLE_VARIANTS[case["variant"]]
+    seed = derive_seed("benchmark", case["variant"], 0)
+
+    baseline_rss = _peak_rss_bytes()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        marble = create_enhanced_marble(
+            width=case["width"],
+            height=case["height"],
+            seed=seed,
+            colors=colors,
+            **params
+        )
+        times.append(time.perf_counter() - start)
+
+    # 中央値と、中央値からの絶対偏差の中央値（中央値に対する割合）をばらつきとして記録する
+    wall_seconds = float(np.median(times))
+    wall_noise = float(np.median(np.abs(np.subtract(times, wall_seconds)))) / wall_seconds
+    result = dict(case)
+    result.update({
+        "iterations": marble.info["iterations"],
+        "wall_seconds": wall_seconds,
+        "wall_seconds_all": times,
+        "wall_noise": wall_noise,
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "import_rss_bytes": baseline_rss,
+        "pixels_per_second": case["width"] * case["height"] / wall_seconds,
+    })
+    return result
+
+
+def run_benchmark(cases, repeat=5, progress=True):
+    """
+    各組み合わせを別々のプロセスで測り、結果を JSON にできる辞書で返す
+    実時間は repeat 回の中央値（たまたま速かった・遅かった1回に引きずられない）。
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for index, case in enumerate(cases, 1):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(_run_case, case, repeat).result()
+        results.append(result)
+        if progress:
+            print(f"[{index}/{len(cases)}] {case['key']}: {result['wall_seconds']:.3f} 秒"
+                  f"（ばらつき {result['wall_noise']:.1%}）, {result['pixels_per_second']:,.0f} px/s", flush=True)
+
+    return {
+        "benchmark_version": BENCHMARK_VERSION,
+        "generator_version": GENERATOR_VERSION,
+        "repeat": repeat,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def benchmark_encoding(resolutions=None, repeat=3, progress=True):
+    """
+    解像度ごとに1枚生成し、各保存形式で画像とサムネイルをエンコードした時間（repeat 回の最小）とバイト数を測る
+    エンコードは生成と違ってメモリをほとんど使わないので、プロセスは分けない。
+    """
+    if resolutions is None:
+        resolutions = RESOLUTIONS
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for width, height in resolutions:
+            marble = create_enhanced_marble(width=width, height=height, seed=derive_seed("benchmark", "encode", 0))
+            thumbnail = marble.reduce(THUMBNAIL_REDUCE)
+            for image_format, (extension, _, _) in IMAGE_FORMATS.items():
+                path = os.path.join(directory, f"marble.{extension}")
+                thumb_path = os.path.join(directory, f"thumb.{extension}")
+                times = []
+                for _ in range(repeat):
+                    seconds, size = _encode_image(marble, path, image_format)
+                    thumb_seconds, thumb_size = _encode_image(thumbnail, thumb_path, image_format)
+                    times.append(seconds + thumb_seconds)
+                result = {
+                    "key": f"{width}x{height}/{image_format}",
+                    "width": width,
+                    "height": height,
+                    "format": image_format,
+                    "encode_seconds": min(times),
+                    "encode_seconds_all": times,
+                    "bytes": size,
+                    "thumbnail_bytes": thumb_size,
+                }
+                results.append(result)
+                if progress:
+                    print(f"{result['key']}: {result['encode_seconds'] * 1000:.1f} ミリ秒, "
+                          f"{size:,} + {thumb_size:,} バイト", flush=True)
+    return results
+
+
+def overall_time_ratio(report, baseline):
+    """
+    baseline と共通の組み合わせについて、実時間の比（今回 / ベースライン）の幾何平均と組み合わせの数を返す
+    1つの組み合わせの時間は測るたびに2〜3割ぶれることがあるが、全体の平均ならぶれが打ち消し合う。
+    """
+    previous = {result["key"]: result for result in baseline["results"]}
+    ratios = [result["wall_seconds"] / previous[result["key"]]["wall_seconds"]
+              for result in report["results"] if result["key"] in previous]
+    if not ratios:
+        return None, 0
+    return float(np.exp(np.mean(np.log(ratios)))), len(ratios)
+
+
+def compare_to_baseline(report, baseline, time_tolerance=0.1, case_time_tolerance=0.5, memory_tolerance=0.1):
+    """
+    baseline と同じ組み合わせを比べ、許容範囲を超えて悪化したものを返す
+    time_tolerance=0.1 なら、全組み合わせの実時間の比の幾何平均（overall_time_ratio）が 10% を超えて増えたときに
+    key が "全体" の項目を返す。1つの組み合わせの実時間は case_time_tolerance（今回とベースラインの大きい方の
+    ばらつき wall_noise の NOISE_FACTOR 倍まで広げる）、ピーク RSS は memory_tolerance を超えて増えたものを返す。
+    """
+    regressions = []
+    ratio, count = overall_time_ratio(report, baseline)
+    if ratio is not None and ratio > 1 + time_tolerance:
+        regressions.append({
+            "key": f"全体（{count} 組み合わせの幾何平均）",
+            "metric": "wall_seconds",
+            "tolerance": time_tolerance,
+            "baseline": 1.0,
+            "current": ratio,
+            "ratio": ratio,
+        })
+    
+    previous = {result["key"]: result for result in baseline["results"]}
+    for result in report["results"]:
+        before = previous.get(result["key"])
+        if before is None:
+            continue
+        noise = max(result.get("wall_noise") or 0, before.get("wall_noise") or 0)
+        checks = [("wall_seconds", max(case_time_tolerance, NOISE_FACTOR * noise)),
+                  ("peak_rss_bytes", memory_tolerance)]
+        for metric, tolerance in checks:
+            if result.get(metric) is None or before.get(metric) is None:
+                continue
+            ratio = result[metric] / before[metric]
+            if ratio > 1 + tolerance:
+                regressions.append({
+                    "key": result["key"],
+                    "metric": metric,
+                    "tolerance": tolerance,
+                    "baseline": before[metric],
+                    "current": result[metric],
+                    "ratio": ratio,
+                })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="マーブル模様ジェネレーターのベンチマーク")
+    parser.add_argument("--output", default="benchmark.json", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="比べる前回の結果の JSON ファイル（既定はリポジトリの benchmark_baseline.json）")
+    parser.add_argument("--no-baseline", action="store_true", help="ベースラインと比べない")
+    parser.add_argument("--repeat", type=int, default=5, help="組み合わせごとの生成回数（中央値の時間を使う）")
+    parser.add_argument("--full", action="store_true", help="すべての解像度（1920x1080 まで）を測る")
+    parser.add_argument("--variants", nargs="+", choices=list(MARBLE_VARIANTS), help="測るバリエーション")
+    parser.add_argument("--time-tolerance", type=float, default=0.1,
+                        help="全組み合わせの実時間の比（幾何平均）の増加の許容割合")
+    parser.add_argument("--case-time-tolerance", type=float, default=0.5,
+                        help="1つの組み合わせの実時間の増加の許容割合（繰り返しのばらつきが大きければ自動で広げる）")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1, help="ピーク RSS の増加の許容割合")
+    parser.add_argument("--encode", action="store_true", help="生成ではなく保存形式ごとのエンコードを測る")
+    args = parser.parse_args(argv)
+
+    if args.encode:
+        results = benchmark_encoding(RESOLUTIONS if args.full else QUICK_RESOLUTIONS, repeat=args.repeat)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"benchmark_version": BENCHMARK_VERSION, "encoding": results}, f, ensure_ascii=False, indent=2)
+        print(f"結果を {args.output} に保存しました")
+        return 0
+
+    cases = benchmark_cases(RESOLUTIONS if args.full else QUICK_RESOLUTIONS, args.variants)
+    report = run_benchmark(cases, repeat=args.repeat)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.output} に保存しました")
+
+    if not args.no_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"{args.baseline} と比べます")
+        if baseline.get("benchmark_version") != report["benchmark_version"]:
+            print(f"注意: ベースラインの BENCHMARK_VERSION は {baseline.get('benchmark_version')} です（測り方が違います）")
+        if baseline.get("generator_version") != report["generator_version"]:
+            print(f"注意: ベースラインの GENERATOR_VERSION は {baseline.get('generator_version')} です（出力が変わる変更を含みます）")
+        # 別の環境で測ったベースラインとの時間の差は、変更によるものとは限らない
+        # 環境が違えば、時間の悪化は報告するだけで失敗にしない（メモリの悪化は失敗にする）
+        environment = baseline.get("environment", {})
+        same_environment = True
+        for key in ENVIRONMENT_KEYS:
+            if environment.get(key) != report["environment"][key]:
+                same_environment = False
+                print(f"注意: ベースラインの {key} は {environment.get(key)} です（今回は {report['environment'][key]}）")
+        ratio, count = overall_time_ratio(report, baseline)
+        if ratio is not None:
+            print(f"全体の実時間: ベースラインの {ratio:.3f} 倍（共通の {count} 組み合わせの比の幾何平均）")
+        regressions = compare_to_baseline(report, baseline, args.time_tolerance, args.case_time_tolerance,
+                                          args.memory_tolerance)
+        failures = 0
+        for regression in regressions:
+            label = "悪化"
+            if regression["metric"] == "wall_seconds" and not same_environment:
+                label = "差（環境が違うので参考）"
+            else:
+                failures += 1
+            print(f"{label}: {regression['key']} の {regression['metric']} が "
+                  f"{regression['baseline']:.4g} → {regression['current']:.4g}"
+                  f"（{regression['ratio']:.2f} 倍、許容 {1 + regression['tolerance']:.2f} 倍）")
+        if failures:
+            return 1
+        print("ベースラインからの悪化はありません" if not regressions else "失敗にする悪化はありません")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,267 +1,1527 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter
-from PIL import Image, ImageEnhance, ImageFilter
+from scipy.ndimage import gaussian_filter, gaussian_filter1d, zoom
+from scipy import fft
+from PIL import Image
 import os
 import json
+import hashlib
+import io
+import struct
+import tempfile
+import zlib
+import copy
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
 
-def create_enhanced_marble(width=800, height=600, iterations=100, speed=0.8, 
-                         diffusion_rate=0.12, viscosity=0.35, seed=None,
-                         colors=None, vortex_count=None, vortex_strength=None):
+@contextmanager
+def _phase(on_phase, name):
     """
-    改良版マーブル模様生成関数
-    様々なパラメータでマーブルテクスチャを生成
+    with ブロックを1つのフェーズとして計測し、on_phase(name, 秒数, ピークバイト数) を呼ぶ
+    ピークバイト数は tracemalloc が計測中のときだけ分かり、そうでなければ None になる。
+    on_phase が None なら何もしない。
+    """
+    if on_phase is None:
+        yield
+        return
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    on_phase(name, seconds, tracemalloc.get_traced_memory()[1] if tracing else None)
+
+class PhaseProfiler:
+    """
+    create_enhanced_marble などの on_phase に渡して、フェーズごとの時間とピークメモリを集計する
+    with 文の中で使うと tracemalloc を開始・停止してピークメモリも記録する（計測中はやや遅くなる）。
+    反復ごとのフェーズ（velocity, advection, diffusion）は回数・合計・最大をまとめる。
     """
-    if seed is not None:
-        np.random.seed(seed)
+    def __init__(self):
+        self.records = []
+        self._started_tracing = False
     
-    # デフォルトの色パレット
-    if colors is None:
-        colors = [
-            (255, 255, 255),      # 白
-            (240, 248, 255),      # アリスブルー
-            (230, 240, 250),      # とても薄い青
-            (220, 235, 245),      # 薄い青みがかった白
-            (200, 230, 240),      # 薄い水色
-            (176, 220, 230),      # パウダーブルー
-            (173, 216, 230),      # ライトブルー
-            (135, 206, 235),      # スカイブルー
-            (135, 206, 250),      # ライトスカイブルー
-            (176, 196, 222),      # ライトスティールブルー
-            (100, 149, 237),      # コーンフラワーブルー
-            (70, 130, 180),       # スティールブルー
-            (123, 167, 165),      # 薄い青緑
-            (95, 158, 160),       # カデットブルー
-            (115, 168, 170),      # 薄い青緑2
-            (170, 200, 190),      # 薄い緑がかった青
-        ]
-    
-    # 速度場の初期化
-    velocity_x = np.zeros((height, width))
-    velocity_y = np.zeros((height, width))
-    
-    # 色素フィールドの初期化
-    dye_fields = []
-    for _ in range(len(colors)):
-        dye_field = np.zeros((height, width))
-        
-        # ランダムな位置に色素の滴を配置
-        num_drops = np.random.randint(30, 70)
-        for _ in range(num_drops):
-            x = np.random.randint(0, width)
-            y = np.random.randint(0, height)
-            radius = np.random.randint(3, 50)
-            strength = np.random.random() * 0.9 + 0.1
-            
-            # 画像の範囲内に制限
-            y_min, y_max = max(0, y-radius), min(height, y+radius+1)
-            x_min, x_max = max(0, x-radius), min(width, x+radius+1)
-            
-            # この領域サイズに合わせたマスクを作成
-            mask_height = y_max - y_min
-            mask_width = x_max - x_min
-            
-            # マスクを作成
-            y_indices, x_indices = np.ogrid[:mask_height, :mask_width]
-            center_y = radius if y - radius >= 0 else y
-            center_x = radius if x - radius >= 0 else x
-            
-            # 領域サイズに合わせたマスクを作成（円形または楕円形）
-            if np.random.random() > 0.5:
-                # 円形
-                mask = ((y_indices - center_y)**2 + (x_indices - center_x)**2) <= radius**2
-            else:
-                # 楕円形 - より自然な形状
-                a = radius * (0.6 + np.random.random() * 0.8)
-                b = radius * (0.6 + np.random.random() * 0.8)
-                angle = np.random.random() * np.pi
-                cosa = np.cos(angle)
-                sina = np.sin(angle)
-                
-                y_rot = (y_indices - center_y) * cosa - (x_indices - center_x) * sina
-                x_rot = (y_indices - center_y) * sina + (x_indices - center_x) * cosa
-                
-                mask = ((y_rot/a)**2 + (x_rot/b)**2) <= 1
-            
-            # 滴の濃度を中心から外側に向かって徐々に減少させる
-            if np.random.random() > 0.3:
-                y_dist = np.abs(y_indices - center_y)
-                x_dist = np.abs(x_indices - center_x)
-                dist = np.sqrt((y_dist**2 + x_dist**2))
-                fade = 1 - (dist / radius) ** 2
-                fade[~mask] = 0
-                dye_field[y_min:y_max, x_min:x_max] += fade * strength
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+    
+    def __call__(self, name, seconds, peak_bytes):
+        self.records.append((name, seconds, peak_bytes))
+    
+    def summary(self):
+        """JSON にそのまま書き出せる、フェーズ名ごとの集計（最初に現れた順）"""
+        phases = {}
+        for name, seconds, peak_bytes in self.records:
+            phase = phases.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "peak_bytes": None})
+            phase["count"] += 1
+            phase["total_seconds"] += seconds
+            phase["max_seconds"] = max(phase["max_seconds"], seconds)
+            if peak_bytes is not None:
+                phase["peak_bytes"] = max(phase["peak_bytes"] or 0, peak_bytes)
+        for phase in phases.values():
+            phase["mean_seconds"] = phase["total_seconds"] / phase["count"]
+        peaks = [phase["peak_bytes"] for phase in phases.values() if phase["peak_bytes"] is not None]
+        return {
+            "total_seconds": sum(phase["total_seconds"] for phase in phases.values()),
+            "peak_bytes": max(peaks) if peaks else None,
+            "phases": phases,
+        }
+
+class AdvectionPlan:
+    """
+    バイリニア補間による移流の計画
+    補間の座標と重みは速度場だけで決まるので、速度場の更新ごとに1回計算して全色素で使い回す。
+    作業用バッファは生成時に1回だけ確保する。
+    num_workers を2以上にすると、色素を範囲に分けて複数のスレッドから同時に apply できる。
+    """
+    # 補間値を一度に集める色素の数（作業用バッファのサイズを色数に依存させないため）
+    gather_chunk = 4
+    
+    def __init__(self, height, width, num_fields, dtype=np.float32, periodic=False, num_workers=1):
+        self.height = height
+        self.width = width
+        # True なら画像の端で反対側に回り込む（周期境界）。False なら端で止める
+        self.periodic = periodic
+        
+        # 座標（全画面のグリッドは作らず、ブロードキャストで使う）
+        self.y_coords = np.arange(height, dtype=dtype)[:, np.newaxis]
+        self.x_coords = np.arange(width, dtype=dtype)[np.newaxis, :]
+        
+        # 移動先の座標（小数部分の計算にも使い回す）
+        self.new_x = np.empty((height, width), dtype=dtype)
+        self.new_y = np.empty((height, width), dtype=dtype)
+        self.x_int = np.empty((height, width), dtype=np.int32)
+        self.y_int = np.empty((height, width), dtype=np.int32)
+        
+        # 4つの隣接点（左上, 右上, 左下, 右下）の平坦化インデックスと補間の重み
+        # 画素数が int32 に収まらない場合だけ intp を使う
+        index_dtype = np.int32 if height * width < 2**31 else np.intp
+        self.indices = np.empty((4, height * width), dtype=index_dtype)
+        self.weights = np.empty((4, height * width), dtype=dtype)
+        
+        # 色素の補間用バッファ（スレッドごとに1つ）
+        self.gathered = np.empty((num_workers, min(num_fields, self.gather_chunk), height * width), dtype=dtype)
+        self.result = np.empty((num_fields, height, width), dtype=dtype)
+    
+    def update(self, velocity_x, velocity_y, origin=(0, 0), source=None, image_size=None):
+        """
+        速度場から補間の座標と重みを計算し直す
+        タイル処理では、この計画の格子が画像全体の一部になる。
+        origin: 格子の左上の画像全体での位置 (y, x)
+        source: apply に渡す補間元の領域 (上端, 左端, 高さ, 幅)。既定は格子と同じ領域
+        image_size: 画像全体の (高さ, 幅)。移動先はこの範囲内に制限する。既定は格子と同じ大きさ
+        """
+        width, height = self.width, self.height
+        new_x, new_y = self.new_x, self.new_y
+        x_int, y_int = self.x_int, self.y_int
+        source_top, source_left, source_height, source_width = source or (0, 0, height, width)
+        image_height, image_width = image_size or (height, width)
+        
+        # 格子の座標（タイルの場合は画像全体での座標）
+        x_coords, y_coords = self.x_coords, self.y_coords
+        if origin != (0, 0):
+            y_coords = np.arange(origin[0], origin[0] + height, dtype=y_coords.dtype)[:, np.newaxis]
+            x_coords = np.arange(origin[1], origin[1] + width, dtype=x_coords.dtype)[np.newaxis, :]
+        
+        # 新しい位置を計算し、境界条件（画像の範囲内に制限）を適用
+        np.add(x_coords, velocity_x, out=new_x)
+        np.add(y_coords, velocity_y, out=new_y)
+        if self.periodic:
+            return self._update_periodic()
+        np.clip(new_x, 0, image_width - 1, out=new_x)
+        np.clip(new_y, 0, image_height - 1, out=new_y)
+        
+        # 整数部分と小数部分に分離（new_x, new_y は小数部分になる）
+        x_int[...] = new_x
+        y_int[...] = new_y
+        new_x -= x_int
+        new_y -= y_int
+        
+        # 補間元の領域内での位置にする
+        if source_left:
+            x_int -= source_left
+        if source_top:
+            y_int -= source_top
+        
+        # 平坦化インデックス（補間に使う隣接ピクセルは境界を考慮）
+        indices = self.indices.reshape(4, height, width)
+        y_int *= source_width
+        np.add(y_int, x_int, out=indices[0])
+        np.add(y_int, source_width, out=indices[2])
+        np.minimum(indices[2], (image_height - 1 - source_top) * source_width, out=indices[2])
+        indices[3] = indices[2]
+        indices[2] += x_int
+        x_int += 1
+        np.minimum(x_int, image_width - 1 - source_left, out=x_int)
+        np.add(y_int, x_int, out=indices[1])
+        indices[3] += x_int
+        
+        self._update_weights()
+    
+    def _update_weights(self):
+        """小数部分（new_x, new_y）からバイリニア補間用の重みを計算する"""
+        new_x, new_y = self.new_x, self.new_y
+        weights = self.weights.reshape(4, self.height, self.width)
+        np.subtract(1, new_x, out=weights[0])
+        np.multiply(weights[0], new_y, out=weights[2])
+        np.subtract(1, new_y, out=weights[1])
+        np.multiply(weights[0], weights[1], out=weights[0])
+        np.multiply(new_x, weights[1], out=weights[1])
+        np.multiply(new_x, new_y, out=weights[3])
+    
+    def _update_periodic(self):
+        """周期境界の場合の update の続き（タイル処理には対応しない）"""
+        width, height = self.width, self.height
+        new_x, new_y = self.new_x, self.new_y
+        x_int, y_int = self.x_int, self.y_int
+        
+        # 画像の範囲に折り返してから、整数部分と小数部分に分離する
+        np.mod(new_x, width, out=new_x)
+        np.mod(new_y, height, out=new_y)
+        x_int[...] = new_x
+        y_int[...] = new_y
+        new_x -= x_int
+        new_y -= y_int
+        # 丸め誤差でちょうど width（height）になった座標は 0 に回す
+        x_int[x_int == width] = 0
+        y_int[y_int == height] = 0
+        
+        # 平坦化インデックス（右隣・下隣は反対側の端に回り込む）
+        indices = self.indices.reshape(4, height, width)
+        y_next = y_int + 1
+        y_next[y_next == height] = 0
+        y_int *= width
+        y_next *= width
+        np.add(y_int, x_int, out=indices[0])
+        np.add(y_next, x_int, out=indices[2])
+        x_int += 1
+        x_int[x_int == width] = 0
+        np.add(y_int, x_int, out=indices[1])
+        np.add(y_next, x_int, out=indices[3])
+        
+        self._update_weights()
+    
+    def apply(self, fields, start=0, stop=None, worker=0):
+        """
+        (色数, 高さ, 幅) の色素場をまとめて移流させ、作業用バッファに結果を書き込んで返す
+        start, stop を指定すると、その範囲の色素だけを移流させて結果の同じ範囲に書き込む。
+        worker ごとに別の補間用バッファを使うので、範囲が重ならなければ複数のスレッドから同時に呼べる。
+        """
+        if stop is None:
+            stop = len(fields)
+        flat_fields = fields.reshape(len(fields), -1)[start:stop]
+        result = self.result.reshape(len(fields), -1)[start:stop]
+        num_fields = stop - start
+        
+        # 4つの隣接点からの寄与を計算（インデックスと重みは全色素で共通）
+        np.take(flat_fields, self.indices[0], axis=1, out=result, mode='clip')
+        result *= self.weights[0]
+        for chunk_start in range(0, num_fields, self.gather_chunk):
+            chunk_stop = min(chunk_start + self.gather_chunk, num_fields)
+            gathered = self.gathered[worker, :chunk_stop - chunk_start]
+            for k in range(1, 4):
+                np.take(flat_fields[chunk_start:chunk_stop], self.indices[k], axis=1, out=gathered, mode='clip')
+                gathered *= self.weights[k]
+                result[chunk_start:chunk_stop] += gathered
+        
+        return self.result
+
+class PeriodicGaussian:
+    """
+    周期境界のガウシアンフィルタを FFT で行う（gaussian_filter の mode='wrap' と同じ結果になる）
+    伝達関数（カーネルのフーリエ変換）は sigma ごとに1回だけ計算し、全反復・全色素で使い回す。
+    sigma が大きいほど空間フィルタより速い。
+    """
+    def __init__(self, height, width, dtype=np.float32):
+        self.height = height
+        self.width = width
+        self.dtype = np.dtype(dtype)
+        self._transfers = {}
+    
+    def transfer(self, sigma):
+        """
+        sigma の伝達関数 (高さ, 幅 // 2 + 1) を返す
+        gaussian_filter と同じ切り詰めたカーネルを周期的に置いたもののフーリエ変換で、
+        カーネルの半径が 0（ぼかさない）なら None を返す。
+        """
+        if sigma not in self._transfers:
+            transfer = None
+            if int(4.0 * sigma + 0.5) > 0:
+                impulse_y = np.zeros(self.height)
+                impulse_y[0] = 1
+                impulse_x = np.zeros(self.width)
+                impulse_x[0] = 1
+                transfer_y = fft.fft(gaussian_filter1d(impulse_y, sigma, mode='wrap'))
+                transfer_x = fft.rfft(gaussian_filter1d(impulse_x, sigma, mode='wrap'))
+                complex_dtype = np.result_type(self.dtype, np.complex64)
+                transfer = (transfer_y[:, np.newaxis] * transfer_x[np.newaxis, :]).astype(complex_dtype)
+            self._transfers[sigma] = transfer
+        return self._transfers[sigma]
+    
+    def __call__(self, field, sigma, output=None):
+        """field の最後の2軸（高さ・幅）を sigma でぼかし、output（省略時は field）に書き込む"""
+        if output is None:
+            output = field
+        transfer = self.transfer(sigma)
+        if transfer is None:
+            if output is not field:
+                output[...] = field
+            return output
+        spectrum = fft.rfft2(field)
+        spectrum *= transfer
+        output[...] = fft.irfft2(spectrum, s=(self.height, self.width))
+        return output
+
+def _drop_template(radius):
+    """半径 radius の滴の矩形範囲 (2r+1)x(2r+1) での縦横のずれ（float32）と中心からの距離の2乗（同じ半径の滴で使い回す）"""
+    offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+    dy = offsets[:, np.newaxis]
+    dx = offsets[np.newaxis, :]
+    return dy, dx, dy * dy + dx * dx
+
+def _stamp_dye_drops(dye_fields, rng, periodic=False):
+    """
+    全色の色素の滴をまとめて配置する
+    滴のパラメータを配列で一括生成し、同じ半径の滴ごとにマスクと濃度を矩形範囲でまとめて計算してから、
+    1滴ずつ描画順に色素場の矩形範囲へ書き込む（重なった滴の上書きと加算の順序は1滴ずつ描く場合と同じ）。
+    periodic が True なら、画像の端からはみ出した部分は反対側に回り込ませる。
+    乱数はすべて rng（np.random.Generator）から引く。
+    """
+    num_colors, height, width = dye_fields.shape
+    
+    # ランダムな位置に色素の滴を配置（色ごとに30〜70滴）
+    num_drops = rng.integers(30, 70, size=num_colors)
+    channel = np.repeat(np.arange(num_colors), num_drops)
+    n = len(channel)
+    x = rng.integers(0, width, size=n)
+    y = rng.integers(0, height, size=n)
+    radius = rng.integers(3, 50, size=n)
+    strength = rng.random(n) * 0.9 + 0.1
+    
+    # 円形または楕円形 - 楕円はより自然な形状
+    is_circle = rng.random(n) > 0.5
+    a = radius * (0.6 + rng.random(n) * 0.8)
+    b = radius * (0.6 + rng.random(n) * 0.8)
+    angle = rng.random(n) * np.pi
+    
+    # 濃度を中心から外側に向かって徐々に減少させる滴（それ以外は一様な濃度で上書き）
+    has_fade = rng.random(n) > 0.3
+    
+    # 回転した楕円を「二次形式 <= 半径の2乗」で表す
+    cosa, sina = np.cos(angle), np.sin(angle)
+    coef_yy = (radius**2 * (cosa**2 / a**2 + sina**2 / b**2)).astype(np.float32)
+    coef_xx = (radius**2 * (sina**2 / a**2 + cosa**2 / b**2)).astype(np.float32)
+    coef_xy = (radius**2 * 2 * cosa * sina * (1 / b**2 - 1 / a**2)).astype(np.float32)
+    r_sq = (radius**2).astype(np.float32)
+    strength32 = strength.astype(np.float32)
+    fade_scale = (strength / radius**2).astype(np.float32)
+    
+    # 半径ごとに滴をまとめ、矩形範囲でのマスクと（濃度が減少する滴の）濃度を一括で計算する
+    # 円のマスクは半径ごとに1つで、滴ごとに計算するのは楕円のマスクと濃度だけ
+    masks = [None] * n
+    fades = [None] * n
+    for r in np.unique(radius):
+        ids = np.flatnonzero(radius == r)
+        dy, dx, dist_sq = _drop_template(r)
+        
+        # 円形または楕円形のマスク
+        bucket_masks = np.empty((len(ids),) + dist_sq.shape, dtype=bool)
+        bucket_masks[is_circle[ids]] = dist_sq <= r_sq[ids[0]]
+        ellipses = ids[~is_circle[ids]]
+        if len(ellipses):
+            form = coef_xy[ellipses, np.newaxis, np.newaxis] * dy + coef_xx[ellipses, np.newaxis, np.newaxis] * dx
+            form *= dx
+            form += coef_yy[ellipses, np.newaxis, np.newaxis] * (dy * dy)
+            bucket_masks[~is_circle[ids]] = form <= r_sq[ellipses, np.newaxis, np.newaxis]
+        
+        # 滴の濃度を中心から外側に向かって徐々に減少させる（マスクの外は 0）
+        fading = ids[has_fade[ids]]
+        bucket_fades = strength32[fading, np.newaxis, np.newaxis] - fade_scale[fading, np.newaxis, np.newaxis] * dist_sq
+        bucket_fades[~bucket_masks[has_fade[ids]]] = 0
+        
+        for drop, mask in zip(ids.tolist(), bucket_masks):
+            masks[drop] = mask
+        for drop, fade in zip(fading.tolist(), bucket_fades):
+            fades[drop] = fade
+    
+    # 1滴ずつ描画順に書き込む。上書き型の滴はマスク内を一様な濃度で上書きし、それ以外は濃度を加算する
+    for drop, (c, cy, cx, r, value) in enumerate(zip(channel.tolist(), y.tolist(), x.tolist(),
+                                                     radius.tolist(), strength.tolist())):
+        field = dye_fields[c]
+        top, left = cy - r, cx - r
+        size = 2 * r + 1
+        if periodic and (top < 0 or left < 0 or top + size > height or left + size > width):
+            # 画像の端にかかる滴は、はみ出した部分を反対側に回り込ませた画素の位置に書き込む
+            mask_y, mask_x = np.nonzero(masks[drop])
+            pixels = ((top + mask_y) % height, (left + mask_x) % width)
+            if fades[drop] is None:
+                field[pixels] = value
             else:
-                dye_field[y_min:y_max, x_min:x_max][mask] = strength
-        
-        dye_fields.append(dye_field)
-    
-    # 力場の追加（3層の周波数）
-    force_field_x = np.zeros((height, width))
-    force_field_y = np.zeros((height, width))
-    
-    # 大きなスケールの動き
-    large_scale_x = gaussian_filter(np.random.random((height, width)) * 2 - 1, sigma=30.0) * speed * 0.5
-    large_scale_y = gaussian_filter(np.random.random((height, width)) * 2 - 1, sigma=30.0) * speed * 0.5
-    
-    # 中程度のスケールの動き
-    medium_scale_x = gaussian_filter(np.random.random((height, width)) * 2 - 1, sigma=15.0) * speed * 0.3
-    medium_scale_y = gaussian_filter(np.random.random((height, width)) * 2 - 1, sigma=15.0) * speed * 0.3
-    
-    # 小さなスケールの動き
-    small_scale_x = gaussian_filter(np.random.random((height, width)) * 2 - 1, sigma=5.0) * speed * 0.2
-    small_scale_y = gaussian_filter(np.random.random((height, width)) * 2 - 1, sigma=5.0) * speed * 0.2
-    
-    # 力場を合成
-    force_field_x = large_scale_x + medium_scale_x + small_scale_x
-    force_field_y = large_scale_y + medium_scale_y + small_scale_y
-    
-    # 渦の数をカスタマイズ可能に
-    if vortex_count is None:
-        vortex_count = np.random.randint(15, 25)
-    
-    # 渦の追加
-    for _ in range(vortex_count):
-        cx = np.random.randint(width//8, width*7//8)
-        cy = np.random.randint(height//8, height*7//8)
-        
-        # より多様な半径の渦
-        if np.random.random() > 0.6:
-            radius = np.random.randint(100, 200)
-            strength = (np.random.random() * 2.0 - 1.0) * speed * 1.5
-        elif np.random.random() > 0.5:
-            radius = np.random.randint(50, 100)
-            strength = (np.random.random() * 2.0 - 1.0) * speed * 2
+                np.add.at(field, pixels, fades[drop][mask_y, mask_x])
+            continue
+        
+        # 画像の範囲内に制限
+        y_min, y_max = max(0, top), min(height, top + size)
+        x_min, x_max = max(0, left), min(width, left + size)
+        box = (slice(y_min - top, y_max - top), slice(x_min - left, x_max - left))
+        if fades[drop] is None:
+            field[y_min:y_max, x_min:x_max][masks[drop][box]] = value
         else:
-            radius = np.random.randint(20, 50)
-            strength = (np.random.random() * 2.0 - 1.0) * speed * 3
+            field[y_min:y_max, x_min:x_max] += fades[drop][box]
+
+def _downsample(field, factor, periodic=False):
+    """
+    最後の2軸（高さ・幅）を factor × factor のマスごとに平均して縮小する
+    割り切れない端は端の値で埋める（periodic なら反対側の値で埋める）。
+    """
+    height, width = field.shape[-2:]
+    pad_y, pad_x = -height % factor, -width % factor
+    if pad_y or pad_x:
+        field = np.pad(field, [(0, 0)] * (field.ndim - 2) + [(0, pad_y), (0, pad_x)],
+                       mode='wrap' if periodic else 'edge')
+    blocks = field.reshape(field.shape[:-2] + (field.shape[-2] // factor, factor, field.shape[-1] // factor, factor))
+    return blocks.mean(axis=(-3, -1))
+
+def _upsample(field, factor, shape, periodic=False):
+    """_downsample の逆に、最後の2軸を factor 倍に線形補間で拡大して shape に切りそろえる"""
+    scale = (1,) * (field.ndim - 2) + (factor, factor)
+    enlarged = zoom(field, scale, order=1, mode='grid-wrap' if periodic else 'nearest', grid_mode=True)
+    return np.ascontiguousarray(enlarged[..., :shape[0], :shape[1]])
+
+class _MarbleState:
+    """
+    MarbleSimulation と TiledMarbleSimulation に共通の、シミュレーションの初期状態（速度場・力場・色素場）の作成
+    状態の配列は _zeros で確保するので、派生クラスで置き場所（メモリ・memmap）を変えられる。
+    引数は MarbleSimulation を参照。
+    """
+    def __init__(self, width=800, height=600, iterations=100, speed=0.8,
+                 diffusion_rate=0.12, viscosity=0.35, seed=None,
+                 num_dyes=16, vortex_count=None, vortex_strength=None,
+                 dtype=np.float32, periodic=False, on_phase=None, n_threads=1, progress=None):
+        dtype = np.dtype(dtype)
         
-        # 渦の強さをカスタマイズ可能に
-        if vortex_strength is not None:
-            strength *= vortex_strength
+        self._init_runtime(on_phase=on_phase, n_threads=n_threads, progress=progress)
+        self.width = width
+        self.height = height
+        self.iterations = iterations
+        self.speed = speed
+        self.diffusion_rate = diffusion_rate
+        self.viscosity = viscosity
+        self.num_dyes = num_dyes
+        self.iteration = 0
+        # 格子1マスが元の解像度の何ピクセル分か（coarsen で大きくなる）
+        self.scale = 1
+        self.periodic = periodic
         
-        y_indices, x_indices = np.ogrid[:height, :width]
-        r = np.sqrt((x_indices - cx)**2 + (y_indices - cy)**2)
-        theta = np.arctan2(y_indices - cy, x_indices - cx)
+        # 乱数はすべてこの Generator から引く（グローバルな np.random の状態は使わない）
+        rng = np.random.default_rng(seed)
+        self.rng = rng
         
-        mask = r < radius
+        # 速度場の初期化
+        velocity_x = self._zeros("velocity_x", (height, width), dtype)
+        velocity_y = self._zeros("velocity_y", (height, width), dtype)
         
-        # 渦の形状をバリエーション
-        if np.random.random() > 0.5:
-            decay = (1.0 - r[mask] / radius) ** 2
-        else:
-            decay = (1.0 - r[mask] / radius) ** 3
-        
-        # 渦の効果を速度場に追加
-        vx = -np.sin(theta[mask]) * decay * strength
-        vy = np.cos(theta[mask]) * decay * strength
-        
-        force_field_x[mask] += vx
-        force_field_y[mask] += vy
-    
-    # メインのシミュレーションループ
-    for i in range(iterations):
-        # 速度場を更新（徐々に減衰させる）
-        decay_factor = 0.95 if i > iterations // 2 else 0.98
-        velocity_x = velocity_x * decay_factor + force_field_x
-        velocity_y = velocity_y * decay_factor + force_field_y
-        
-        # 拡散（速度場をスムージング）
-        velocity_x = gaussian_filter(velocity_x, sigma=viscosity)
-        velocity_y = gaussian_filter(velocity_y, sigma=viscosity)
-        
-        # 色素の移流と拡散
-        for j in range(len(dye_fields)):
-            # 移流（速度場に従って色素を移動）
-            y_indices, x_indices = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
-            
-            # 新しい位置を計算
-            new_x = x_indices + velocity_x
-            new_y = y_indices + velocity_y
-            
-            # 境界条件（画像の範囲内に制限）
-            new_x = np.clip(new_x, 0, width - 1)
-            new_y = np.clip(new_y, 0, height - 1)
+        # 色素フィールドの初期化（全色を (色数, 高さ, 幅) の1つの配列で保持）
+        dye_fields = self._zeros("dye_fields", (num_dyes, height, width), dtype)
+        
+        # ランダムな位置に色素の滴を配置（全色の滴をまとめて描く）
+        with _phase(on_phase, "drops"):
+            _stamp_dye_drops(dye_fields, rng, periodic=periodic)
+        
+        # 力場の追加（3層の周波数）
+        force_field_x = self._zeros("force_field_x", (height, width), dtype)
+        force_field_y = self._zeros("force_field_y", (height, width), dtype)
+        
+        # 各スケールの力を順に足し込む（全画面の中間配列を同時に保持しない）
+        with _phase(on_phase, "forces"):
+            for sigma, scale in ((30.0, 0.5), (15.0, 0.3), (5.0, 0.2)):  # 大・中・小のスケールの動き
+                self._add_force_noise(force_field_x, sigma, speed, scale)
+                self._add_force_noise(force_field_y, sigma, speed, scale)
+        
+        with _phase(on_phase, "vortices"):
+            # 渦の数をカスタマイズ可能に
+            if vortex_count is None:
+                vortex_count = rng.integers(15, 25)
             
-            # 整数部分と小数部分に分離
-            new_x_int = new_x.astype(int)
-            new_y_int = new_y.astype(int)
+            # 渦の追加
+            for _ in range(vortex_count):
+                cx = rng.integers(width//8, width*7//8)
+                cy = rng.integers(height//8, height*7//8)
             
-            # バイリニア補間用の重み計算
-            new_x_frac = new_x - new_x_int
-            new_y_frac = new_y - new_y_int
+                # より多様な半径の渦
+                if rng.random() > 0.6:
+                    radius = rng.integers(100, 200)
+                    strength = (rng.random() * 2.0 - 1.0) * speed * 1.5
+                elif rng.random() > 0.5:
+                    radius = rng.integers(50, 100)
+                    strength = (rng.random() * 2.0 - 1.0) * speed * 2
+                else:
+                    radius = rng.integers(20, 50)
+                    strength = (rng.random() * 2.0 - 1.0) * speed * 3
             
-            # 補間に使う隣接ピクセルの座標（境界を考慮）
-            new_x_int_plus1 = np.minimum(new_x_int + 1, width - 1)
-            new_y_int_plus1 = np.minimum(new_y_int + 1, height - 1)
+                # 渦の強さをカスタマイズ可能に
+                if vortex_strength is not None:
+                    strength *= vortex_strength
             
-            # 新しい色素場の計算（バイリニア補間）
-            dye_field_new = np.zeros_like(dye_fields[j])
+                # 渦の影響範囲（r < radius）を含む矩形だけで計算する（周期境界では端で切らない）
+                if periodic:
+                    y_min, y_max = cy - radius + 1, cy + radius
+                    x_min, x_max = cx - radius + 1, cx + radius
+                else:
+                    y_min, y_max = max(0, cy - radius + 1), min(height, cy + radius)
+                    x_min, x_max = max(0, cx - radius + 1), min(width, cx + radius)
+                dy = np.arange(y_min - cy, y_max - cy, dtype=dtype)[:, np.newaxis]
+                dx = np.arange(x_min - cx, x_max - cx, dtype=dtype)[np.newaxis, :]
+                r = np.sqrt(dx**2 + dy**2)
             
-            # 4つの隣接点からの寄与を計算
-            dye_field_new += (1 - new_x_frac) * (1 - new_y_frac) * dye_fields[j][new_y_int, new_x_int]
-            dye_field_new += new_x_frac * (1 - new_y_frac) * dye_fields[j][new_y_int, new_x_int_plus1]
-            dye_field_new += (1 - new_x_frac) * new_y_frac * dye_fields[j][new_y_int_plus1, new_x_int]
-            dye_field_new += new_x_frac * new_y_frac * dye_fields[j][new_y_int_plus1, new_x_int_plus1]
+                mask = r < radius
+                r = r[mask]
             
-            # 拡散（色素をスムージング）
-            diffusion = diffusion_rate
-            # シミュレーション後半で拡散率を変える
-            if i > iterations * 0.7:
-                diffusion *= 0.8  # 後半は拡散を抑える
+                # 渦の形状をバリエーション
+                if rng.random() > 0.5:
+                    decay = (1.0 - r / radius) ** 2
+                else:
+                    decay = (1.0 - r / radius) ** 3
             
-            dye_field_new = gaussian_filter(dye_field_new, sigma=diffusion)
+                # 接線方向の単位ベクトル (-sinθ, cosθ) = (-dy/r, dx/r)。中心では θ = 0 として扱う
+                center = r == 0
+                r[center] = 1
+                sin_theta = np.broadcast_to(dy, mask.shape)[mask] / r
+                cos_theta = np.broadcast_to(dx, mask.shape)[mask] / r
+                cos_theta[center] = 1
             
-            # 更新
-            dye_fields[j] = dye_field_new
+                # 渦の効果を速度場に追加
+                if periodic:
+                    # 画像の端をまたぐ部分は反対側に回り込ませる
+                    rows = np.broadcast_to((np.arange(y_min, y_max) % height)[:, np.newaxis], mask.shape)[mask]
+                    cols = np.broadcast_to((np.arange(x_min, x_max) % width)[np.newaxis, :], mask.shape)[mask]
+                    np.add.at(force_field_x, (rows, cols), -sin_theta * decay * strength)
+                    np.add.at(force_field_y, (rows, cols), cos_theta * decay * strength)
+                else:
+                    force_field_x[y_min:y_max, x_min:x_max][mask] += -sin_theta * decay * strength
+                    force_field_y[y_min:y_max, x_min:x_max][mask] += cos_theta * decay * strength
+        
+        self.velocity_x = velocity_x
+        self.velocity_y = velocity_y
+        self.force_field_x = force_field_x
+        self.force_field_y = force_field_y
+        self.dye_fields = dye_fields
+        
+    def _init_runtime(self, on_phase=None, n_threads=1, progress=None):
+        """
+        save() で保存しない属性（コールバック・スレッド数・作業用の状態・直前の step の結果）を初期値にする
+        __init__ と load() の両方から呼ぶので、保存しない属性を増やすときはここに加える。
+        """
+        # フェーズごとの計測結果を受け取るコールバック（None なら計測しない）
+        self.on_phase = on_phase
+        # 色素の移流と拡散を分けて計算するスレッドの数（結果はスレッド数によらず同じ）
+        self.n_threads = n_threads
+        # 1反復ごとに progress(済んだ反復回数, 予定の反復回数) で呼ばれるコールバック
+        self.progress = progress
+        # 周期境界のぼかしに使う PeriodicGaussian（_smooth で必要になったときに作る）
+        self._periodic_gaussian = None
+        # 直前の step で色素場の変化が tolerance を下回って打ち切ったか
+        self.converged = False
+        # 最後に測った1反復あたりの色素場の変化（tolerance を指定したときだけ測る）
+        self.last_change = None
+    
+    def _zeros(self, name, shape, dtype):
+        """状態を保持する 0 で初期化した配列を確保する"""
+        return np.zeros(shape, dtype=dtype)
     
-    # 色素場の合成方法を改善
-    image = np.ones((height, width, 3), dtype=np.float32) * 255
+    def _add_force_noise(self, force_field, sigma, speed, scale):
+        """なめらかなランダムの力（幅 sigma でぼかした一様乱数）を力場に足し込む"""
+        height, width = force_field.shape
+        noise = self.rng.random((height, width)).astype(force_field.dtype) * 2 - 1
+        force_field += self._smooth(noise, sigma, noise) * speed * scale
     
-    # すべての色素場の合計を計算
-    total_dye = np.zeros((height, width))
-    for dye_field in dye_fields:
-        total_dye += dye_field
+    def _smooth(self, field, sigma, output):
+        """
+        最後の2軸（高さ・幅）を sigma でぼかして output に書き込む
+        周期境界では、伝達関数を使い回す FFT のフィルタで端をまたいでぼかす。
+        """
+        if self.periodic:
+            shape = field.shape[-2:]
+            if self._periodic_gaussian is None or (self._periodic_gaussian.height, self._periodic_gaussian.width) != shape:
+                self._periodic_gaussian = PeriodicGaussian(shape[0], shape[1], dtype=field.dtype)
+            return self._periodic_gaussian(field, sigma, output=output)
+        return gaussian_filter(field, sigma=(0,) * (field.ndim - 2) + (sigma, sigma), output=output)
+
+class MarbleSimulation(_MarbleState):
+    """
+    途中から続けられるマーブル模様の流体シミュレーション
+    速度場・力場・色素場を保持し、step(n) で反復を追加、snapshot() で画像化、save()/load() で .npz に保存・復元できる。
+    iterations は予定の反復回数で、減衰や拡散の切り替え時期に使う（超えて続けた分は後半の設定のまま進む）。
+    coarsen(factor) で格子を粗くして安く反復し、refine() で元の解像度に戻して仕上げることもできる。
+    periodic=True にすると上下・左右の端がつながった周期境界で計算し、並べてもつなぎ目の出ない模様になる。
+    step(n, tolerance=...) では、色素場の変化が十分小さくなった時点で反復を打ち切れる。
+    seed は整数か np.random.Generator で、乱数はすべてその Generator（rng 属性）から引く。
+    on_phase を渡すと、初期化・各反復・合成の各フェーズの時間とピークメモリを報告する（PhaseProfiler を参照）。
+    n_threads を2以上にすると、各反復の色素の移流と拡散を色素ごとに分けてスレッドで並行に計算する。
+    progress を渡すと1反復ごとに呼ばれる。progress から例外を送出すると、その反復までで step を中断できる。
+    """
+    # 収束判定で色素場の変化を測るときの間引き幅（縦横このピクセルおきに比べる）
+    convergence_stride = 4
+
+    # save()/load() で保存するパラメータ
+    PARAM_NAMES = ("width", "height", "iterations", "speed", "diffusion_rate", "viscosity", "num_dyes")
     
-    # 各色素を合成（よりスムーズな混合）
-    for i, dye_field in enumerate(dye_fields):
-        weight = np.clip(dye_field, 0, 1) 
-        color = np.array(colors[i], dtype=np.float32)
+    def step(self, n=1, tolerance=None):
+        """
+        シミュレーションを n 回進める
+        tolerance を指定すると、1反復での色素場の変化（間引いた画素での色素の濃さの差の絶対値の平均）が
+        tolerance を下回った時点で打ち切り、converged を True にする。実際に進めた回数は iteration に反映される。
+        流れが動き出したばかりの前半は変化が小さくても打ち切らず、予定の反復回数の半分を過ぎてから判定する。
+        """
+        iterations = self.iterations
+        velocity_x, velocity_y = self.velocity_x, self.velocity_y
+        dye_fields = self.dye_fields
+        stride = self.convergence_stride
+        self.converged = False
+        completed = 0
+        
+        # 色素ごとの移流と拡散は互いに独立なので、n_threads 個の範囲に分けてスレッドで並行に計算する
+        num_parts = max(1, min(self.n_threads, len(dye_fields)))
+        bounds = np.linspace(0, len(dye_fields), num_parts + 1).astype(int)
+        parts = list(zip(range(num_parts), bounds[:-1], bounds[1:]))
+        executor = ThreadPoolExecutor(max_workers=num_parts) if num_parts > 1 else None
+        
+        def for_each_part(function):
+            """色素の範囲ごとに function(worker, start, stop) を呼び、全部の範囲が終わるまで待つ"""
+            if executor is None:
+                function(0, 0, len(dye_fields))
+            else:
+                list(executor.map(lambda part: function(*part), parts))
         
-        for c in range(3):
-            image[:, :, c] -= weight * (255 - color[c])
+        # 移流の計画（座標グリッドと作業用バッファはここで1回だけ確保）
+        plan = AdvectionPlan(dye_fields.shape[1], dye_fields.shape[2], self.num_dyes, dtype=dye_fields.dtype,
+                             periodic=self.periodic, num_workers=num_parts)
+        
+        # メインのシミュレーションループ
+        on_phase = self.on_phase
+        try:
+            for i in range(self.iteration, self.iteration + n):
+                check = tolerance is not None and i >= iterations // 2
+                if check:
+                    previous = dye_fields[:, ::stride, ::stride].copy()
+                
+                # 速度場を更新（徐々に減衰させる）
+                with _phase(on_phase, "velocity"):
+                    decay_factor = 0.95 if i > iterations // 2 else 0.98
+                    velocity_x *= decay_factor
+                    velocity_x += self.force_field_x
+                    velocity_y *= decay_factor
+                    velocity_y += self.force_field_y
+                    
+                    # 拡散（速度場をスムージング）
+                    # ぼかしの幅はピクセル単位なので、粗い格子ではマス目の大きさで割る
+                    self._smooth(velocity_x, self.viscosity / self.scale, velocity_x)
+                    self._smooth(velocity_y, self.viscosity / self.scale, velocity_y)
+                
+                # 色素の移流と拡散
+                # 移流（速度場に従って色素を移動）
+                # 補間の座標と重みは色素に依存しないので、全色でまとめて1回だけ計算する
+                with _phase(on_phase, "advection"):
+                    plan.update(velocity_x, velocity_y)
+                    for_each_part(lambda worker, start, stop: plan.apply(dye_fields, start, stop, worker))
+                    dye_field_new = plan.result
+                
+                # 拡散（色素をスムージング）
+                with _phase(on_phase, "diffusion"):
+                    diffusion = self.diffusion_rate / self.scale
+                    # シミュレーション後半で拡散率を変える
+                    if i > iterations * 0.7:
+                        diffusion *= 0.8  # 後半は拡散を抑える
+                    
+                    # 色の軸（0軸）はぼかさず、空間方向だけをまとめてスムージング
+                    for_each_part(lambda worker, start, stop: self._smooth(
+                        dye_field_new[start:stop], diffusion, dye_fields[start:stop]))
+                completed += 1
+                if self.progress is not None:
+                    self.progress(i + 1, iterations)
+                
+                # 変化が十分小さくなったら打ち切る
+                if check:
+                    previous -= dye_fields[:, ::stride, ::stride]
+                    self.last_change = float(np.abs(previous).mean())
+                    if self.last_change < tolerance:
+                        self.converged = True
+                        break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            # 途中で中断しても、済んだ反復の分だけ進める
+            self.iteration += completed
+        
+        return self
+    
+    def coarsen(self, factor):
+        """
+        格子を factor 分の1に粗くする（factor × factor のマスを平均）
+        速度と力は「1反復で何マス動くか」なので、マスが大きくなる分だけ小さくする。
+        """
+        if factor <= 1:
+            return self
+        periodic = self.periodic
+        with _phase(self.on_phase, "coarsen"):
+            self.velocity_x = _downsample(self.velocity_x, factor, periodic) / factor
+            self.velocity_y = _downsample(self.velocity_y, factor, periodic) / factor
+            self.force_field_x = _downsample(self.force_field_x, factor, periodic) / factor
+            self.force_field_y = _downsample(self.force_field_y, factor, periodic) / factor
+            self.dye_fields = _downsample(self.dye_fields, factor, periodic)
+        self.scale *= factor
+        return self
+    
+    def refine(self):
+        """粗くした格子を元の解像度（width × height）に戻す"""
+        factor = self.scale
+        if factor <= 1:
+            return self
+        shape = (self.height, self.width)
+        periodic = self.periodic
+        with _phase(self.on_phase, "refine"):
+            self.velocity_x = _upsample(self.velocity_x, factor, shape, periodic) * factor
+            self.velocity_y = _upsample(self.velocity_y, factor, shape, periodic) * factor
+            self.force_field_x = _upsample(self.force_field_x, factor, shape, periodic) * factor
+            self.force_field_y = _upsample(self.force_field_y, factor, shape, periodic) * factor
+            self.dye_fields = _upsample(self.dye_fields, factor, shape, periodic)
+        self.scale = 1
+        return self
     
-    # 値を0-255に収める
-    image = np.clip(image, 0, 255).astype(np.uint8)
+    def snapshot(self, colors, texture_seed=None):
+        """現在の色素場を指定した色で合成した PIL 画像を返す"""
+        return composite_marble(self.dye_fields, colors, texture_seed=texture_seed, periodic=self.periodic,
+                                on_phase=self.on_phase)
     
-    # PILイメージに変換
-    pil_image = Image.fromarray(image)
+    def save(self, path):
+        """シミュレーションの状態を .npz ファイルに保存する"""
+        params = {name: getattr(self, name) for name in self.PARAM_NAMES}
+        params["iteration"] = self.iteration
+        params["scale"] = self.scale
+        params["periodic"] = self.periodic
+        # 乱数の状態も保存し、復元後に続けて引く乱数（テクスチャなど）が保存前と同じになるようにする
+        params["rng_state"] = self.rng.bit_generator.state
+        np.savez_compressed(
+            path,
+            params=json.dumps(params),
+            velocity_x=self.velocity_x,
+            velocity_y=self.velocity_y,
+            force_field_x=self.force_field_x,
+            force_field_y=self.force_field_y,
+            dye_fields=self.dye_fields,
+        )
     
-    # マーブル効果を強調
-    enhancer = ImageEnhance.Contrast(pil_image)
-    pil_image = enhancer.enhance(1.1)
+    @classmethod
+    def load(cls, path):
+        """save() で保存した .npz ファイルからシミュレーションを復元する"""
+        with np.load(path) as data:
+            params = json.loads(str(data["params"]))
+            simulation = cls.__new__(cls)
+            for name in cls.PARAM_NAMES:
+                setattr(simulation, name, params[name])
+            simulation.iteration = params["iteration"]
+            simulation.scale = params.get("scale", 1)
+            simulation.periodic = params.get("periodic", False)
+            simulation._init_runtime()
+            rng_state = params.get("rng_state")
+            if rng_state is None:
+                simulation.rng = np.random.default_rng()
+            else:
+                simulation.rng = np.random.Generator(getattr(np.random, rng_state["bit_generator"])())
+                simulation.rng.bit_generator.state = rng_state
+            simulation.velocity_x = data["velocity_x"]
+            simulation.velocity_y = data["velocity_y"]
+            simulation.force_field_x = data["force_field_x"]
+            simulation.force_field_y = data["force_field_y"]
+            simulation.dye_fields = data["dye_fields"]
+        return simulation
+
+def simulate_marble(width=800, height=600, iterations=100, speed=0.8,
+                    diffusion_rate=0.12, viscosity=0.35, seed=None,
+                    num_dyes=16, vortex_count=None, vortex_strength=None,
+                    dtype=np.float32, pyramid=1, refine_iterations=10, preview=False, periodic=False,
+                    tolerance=None, return_iterations=False, on_phase=None, n_threads=1, progress=None):
+    """
+    マーブル模様の流体シミュレーション部分
+    色には依存しないので、色素の数だけを指定して (色素数, 高さ, 幅) の色素場を返す。
+    色付けは composite_marble で行うので、同じ色素場を別のパレットで何度でも合成し直せる。
+    
+    pyramid: 2以上にすると、初期状態を作ったあと格子を pyramid 分の1に粗くして反復し、
+             最後の refine_iterations 回だけ元の解像度に戻して仕上げる（粗い格子の反復は約 pyramid² 倍速い）。
+    preview: True なら元の解像度に戻さず、粗い格子のまま全反復した色素場を返す。
+             同じシードの本番の画像をそのまま縮小したような、安いプレビューになる。
+    periodic: True なら上下・左右の端がつながった周期境界で計算する（MarbleSimulation を参照）。
+    tolerance: 指定すると、1反復での色素場の変化がこれを下回った時点で反復を打ち切る（MarbleSimulation.step を参照）。
+               ピラミッドモードでは粗い格子での反復に適用し、仕上げの反復は必ず行う。
+    return_iterations: True なら (色素場, 実際に行った反復回数) を返す。
+    on_phase: フェーズごとに on_phase(name, 秒数, ピークバイト数) で呼ばれるコールバック（PhaseProfiler を参照）。
+    n_threads: 色素の移流と拡散を並行に計算するスレッドの数（MarbleSimulation を参照）。
+    progress: 1反復ごとに progress(済んだ反復回数, iterations) で呼ばれるコールバック（MarbleSimulation を参照）。
+    """
+    simulation = MarbleSimulation(
+        width=width,
+        height=height,
+        iterations=iterations,
+        speed=speed,
+        diffusion_rate=diffusion_rate,
+        viscosity=viscosity,
+        seed=seed,
+        num_dyes=num_dyes,
+        vortex_count=vortex_count,
+        vortex_strength=vortex_strength,
+        dtype=dtype,
+        periodic=periodic,
+        on_phase=on_phase,
+        n_threads=n_threads,
+        progress=progress
+    )
+    if pyramid <= 1:
+        simulation.step(iterations, tolerance=tolerance)
+    elif preview:
+        simulation.coarsen(pyramid)
+        simulation.step(iterations, tolerance=tolerance)
+    else:
+        refine_iterations = min(refine_iterations, iterations)
+        simulation.coarsen(pyramid)
+        simulation.step(iterations - refine_iterations, tolerance=tolerance)
+        simulation.refine()
+        simulation.step(refine_iterations)
+    
+    if return_iterations:
+        return simulation.dye_fields, simulation.iteration
+    return simulation.dye_fields
+
+def _blend_dyes(dye_fields, colors, out=None, band_rows=256):
+    """
+    色素場に色を付けて重ね、uint8 の RGB 配列 (高さ, 幅, 3) にする
+    各画素の色は「白 − Σ 色素の濃さ × (白 − 色)」なので、0〜1に収めた色素の山を
+    (色数, 3) の行列と1回の行列積でまとめて掛け合わせる（作業用の配列を抑えるため行の帯ごとに計算する）。
+    画素ごとの計算なので、色素場の一部の領域（タイル）だけを渡してもよい。
+    """
+    if len(colors) > len(dye_fields):
+        raise ValueError(f"色の数 ({len(colors)}) が色素の数 ({len(dye_fields)}) より多いです")
+    
+    dtype = dye_fields.dtype
+    num_colors = len(colors)
+    height, width = dye_fields.shape[1:]
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    
+    # 各色が白から引く量 (色数, 3)
+    darkening = 255 - np.asarray(colors, dtype=dtype).reshape(num_colors, 3)
+    
+    weights = np.empty((num_colors, min(band_rows, height), width), dtype=dtype)
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        band = weights[:, :bottom - top]
+        np.clip(dye_fields[:num_colors, top:bottom], 0, 1, out=band)
+        
+        # (画素数, 色数) × (色数, 3) の行列積で全色の寄与をまとめて求める
+        image = band.reshape(num_colors, -1).T @ darkening
+        np.subtract(255, image, out=image)
+        np.clip(image, 0, 255, out=image)
+        out[top:bottom] = image.reshape(bottom - top, width, 3)
+    
+    return out
+
+# 明るさ（輝度）の重み（PIL の "L" 変換と同じ ITU-R 601-2）
+_LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114])
+
+def _finish_marble(image, texture, image_mean, texture_mean, periodic=False, out=None, band_rows=256):
+    """
+    合成した画像を仕上げる（コントラスト 1.1 → 明るさ 1.05 → テクスチャで白と合成 → SMOOTH_MORE）
+    以前は PIL で1段ずつ画像を作っていた処理を、行の帯ごとに float32 の1回の計算にまとめたもの。
+    image_mean は画像の輝度の平均、texture_mean はテクスチャの平均（コントラストの基準）。
+    画像全体の平均を渡せば、タイルごとに処理しても画像全体で処理した場合と同じになる。
+    """
+    height, width = image.shape[:2]
+    if out is None:
+        out = np.empty_like(image)
+    pad_mode = 'wrap' if periodic else 'symmetric'
     
-    enhancer = ImageEnhance.Brightness(pil_image)
-    pil_image = enhancer.enhance(1.05)
+    # コントラストと明るさは1次式なので1回の掛け算と足し算にまとめる
+    gain = np.float32(1.1 * 1.05)
+    offset = np.float32(image_mean * (1 - 1.1) * 1.05)
     
-    # 微細なテクスチャを追加
-    texture = np.random.random((height, width)) * 10 - 5
-    texture = gaussian_filter(texture, sigma=0.5)
-    texture_image = Image.fromarray(np.uint8(np.clip(texture + 128, 0, 255)))
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        
+        # SMOOTH_MORE 用に上下2行ずつ余分に取る（画像の端では折り返すか、反対側に回り込む）
+        rows = np.arange(top - 2, bottom + 2)
+        if periodic:
+            rows %= height
+        else:
+            rows = np.where(rows < 0, -rows - 1, rows)
+            rows = np.where(rows >= height, 2 * height - rows - 1, rows)
+            rows = np.clip(rows, 0, height - 1)
+        
+        # マーブル効果を強調
+        band = image[rows].astype(np.float32)
+        band *= gain
+        band += offset
+        np.clip(band, 0, 255, out=band)
+        
+        # テクスチャ（コントラストを 0.1 に弱めたもの）の割合で白と合成する
+        mask = texture[rows].astype(np.float32)
+        mask -= texture_mean
+        mask *= np.float32(0.1 / 255)
+        mask += np.float32(texture_mean / 255)
+        band -= 255
+        band *= mask[:, :, np.newaxis]
+        band += 255
+        
+        # 最終的な微調整（SMOOTH_MORE）
+        # 5×5 の重みは「5×5 の箱 + 4 × 3×3 の箱 + 39 × 中心」に分解できるので、ずらした配列の足し算で求める
+        band = np.pad(band, ((0, 0), (2, 2), (0, 0)), mode=pad_mode)
+        rows3 = band[1:-3] + band[2:-2]
+        rows3 += band[3:-1]
+        rows5 = rows3 + band[:-4]
+        rows5 += band[4:]
+        smoothed = rows5[:, :-4] + rows5[:, 1:-3]
+        smoothed += rows5[:, 2:-2]
+        smoothed += rows5[:, 3:-1]
+        smoothed += rows5[:, 4:]
+        box3 = rows3[:, 1:-3] + rows3[:, 2:-2]
+        box3 += rows3[:, 3:-1]
+        box3 *= 4
+        smoothed += box3
+        center = band[2:-2, 2:-2]
+        center *= 39
+        smoothed += center
+        smoothed *= np.float32(1 / 100)
+        np.rint(smoothed, out=smoothed)
+        np.clip(smoothed, 0, 255, out=smoothed)
+        out[top:bottom] = smoothed
+    
+    return out
+
+def composite_marble(dye_fields, colors, texture_seed=None, periodic=False, on_phase=None):
+    """
+    シミュレーション済みの色素場に色を付けてマーブル画像を合成する
+    色素場は先頭から順に colors の各色に対応する（色素が多い場合、余りは使わない）。
+    texture_seed（整数か np.random.Generator）を指定すると微細なテクスチャが固定され、同じ入力から同じ画像になる。
+    periodic が True なら、テクスチャと仕上げのぼかしも端をまたいでかける（並べてもつなぎ目が出ない）。
+    on_phase を渡すと、色の合成（"composite"）と仕上げ（"postprocess"）の時間とピークメモリを報告する。
+    """
+    dtype = dye_fields.dtype
+    height, width = dye_fields.shape[1:]
+    
+    # 色素に色を付けて重ねる
+    with _phase(on_phase, "composite"):
+        image = _blend_dyes(dye_fields, colors)
+    
+    with _phase(on_phase, "postprocess"):
+        # 微細なテクスチャを追加
+        texture = np.random.default_rng(texture_seed).random((height, width))
+        texture = texture.astype(dtype) * 10 - 5
+        texture = gaussian_filter(texture, sigma=0.5, mode='wrap' if periodic else 'reflect')
+        texture = np.uint8(np.clip(texture + 128, 0, 255))
+        
+        # コントラストの基準になる平均
+        image_mean = float(image.reshape(-1, 3).sum(axis=0, dtype=np.int64) @ _LUMA_WEIGHTS) / (height * width)
+        texture_mean = float(texture.sum(dtype=np.int64)) / (height * width)
+        
+        marble = Image.fromarray(_finish_marble(image, texture, image_mean, texture_mean, periodic=periodic))
+    return marble
+
+# デフォルトの色パレット（青と白の大理石風）
+DEFAULT_COLORS = [
+    (255, 255, 255),      # 白
+    (240, 248, 255),      # アリスブルー
+    (230, 240, 250),      # とても薄い青
+    (220, 235, 245),      # 薄い青みがかった白
+    (200, 230, 240),      # 薄い水色
+    (176, 220, 230),      # パウダーブルー
+    (173, 216, 230),      # ライトブルー
+    (135, 206, 235),      # スカイブルー
+    (135, 206, 250),      # ライトスカイブルー
+    (176, 196, 222),      # ライトスティールブルー
+    (100, 149, 237),      # コーンフラワーブルー
+    (70, 130, 180),       # スティールブルー
+    (123, 167, 165),      # 薄い青緑
+    (95, 158, 160),       # カデットブルー
+    (115, 168, 170),      # 薄い青緑2
+    (170, 200, 190),      # 薄い緑がかった青
+]
+
+def create_enhanced_marble(width=800, height=600, iterations=100, speed=0.8, 
+                         diffusion_rate=0.12, viscosity=0.35, seed=None,
+                         colors=None, vortex_count=None, vortex_strength=None,
+                         dtype=np.float32, pyramid=1, refine_iterations=10, preview=False,
+                         periodic=False, tolerance=None, on_phase=None, n_threads=1, progress=None):
+    """
+    改良版マーブル模様生成関数
+    様々なパラメータでマーブルテクスチャを生成
+    
+    seed: 整数か np.random.Generator。乱数は呼び出しごとの Generator から引くので、
+           複数のスレッドで同時に生成しても、同じシードからは同じ画像になる。
+    
+    dtype: シミュレーションと合成に使う浮動小数点型（既定は float32）。
+           np.float64 を指定すると従来どおり倍精度で計算する（メモリ使用量は約2倍）。
+    pyramid, refine_iterations, preview: 粗い格子で反復して速くするモード（simulate_marble を参照）。
+           preview=True のときは幅・高さが約 1/pyramid の画像になる。
+    periodic: True なら上下・左右の端がつながった、タイルのように並べられる模様を生成する。
+    tolerance: 色素場の変化がこれを下回ったら反復を打ち切る（simulate_marble を参照）。
+           実際に行った反復回数は、返す画像の info["iterations"] に入る。
+    on_phase: 滴の配置・力場・渦・各反復（速度場・移流・拡散）・合成・仕上げのフェーズごとに
+           on_phase(name, 秒数, ピークバイト数) で呼ばれるコールバック。集計には PhaseProfiler を使う。
+    n_threads: 2以上にすると、各反復の色素の移流と拡散を色素ごとに分けてスレッドで並行に計算する。
+           1枚を速く仕上げたいとき向け（同じ画像になる）。プロセスを分けるより起動の手間がかからない。
+    progress: 1反復ごとに progress(済んだ反復回数, iterations) で呼ばれるコールバック。
+           進み具合の表示に使い、progress から例外を送出すると生成を中断できる。
+    """
+    # デフォルトの色パレット
+    if colors is None:
+        colors = DEFAULT_COLORS
+    
+    # シミュレーションとテクスチャで同じ Generator を続けて使う（同じシードなら同じ画像になる）
+    rng = np.random.default_rng(seed)
+    
+    dye_fields, iterations_run = simulate_marble(
+        width=width,
+        height=height,
+        iterations=iterations,
+        speed=speed,
+        diffusion_rate=diffusion_rate,
+        viscosity=viscosity,
+        seed=rng,
+        num_dyes=len(colors),
+        vortex_count=vortex_count,
+        vortex_strength=vortex_strength,
+        dtype=dtype,
+        pyramid=pyramid,
+        refine_iterations=refine_iterations,
+        preview=preview,
+        periodic=periodic,
+        tolerance=tolerance,
+        return_iterations=True,
+        on_phase=on_phase,
+        n_threads=n_threads,
+        progress=progress
+    )
+    marble = composite_marble(dye_fields, colors, texture_seed=rng, periodic=periodic, on_phase=on_phase)
+    marble.info["iterations"] = iterations_run
+    return marble
+
+def create_marble_sweep(seeds, width=800, height=600, iterations=100, speed=0.8,
+                        diffusion_rate=0.12, viscosity=0.35,
+                        colors=None, vortex_count=None, vortex_strength=None,
+                        dtype=np.float32, periodic=False, pyramid=4, columns=None, gap=4,
+                        num_dyes=None, n_threads=1, progress=None):
+    """
+    複数のシードの模様を生成し、(一覧の画像, シードごとの画像のリスト) を返す
+    pyramid: 初期状態を width × height で作ったあと 1/pyramid に粗くして反復する。
+             各画像は同じシードの create_enhanced_marble(..., pyramid=pyramid, preview=True) と同じになり、
+             同じシードで本番の大きさに生成した画像を縮めたような見た目になる（お気に入りのシード選び向け）。
+    columns: 一覧の列数（省略時はなるべく正方形に並べる）。gap は画像の間の余白（ピクセル）。
+    num_dyes: シミュレーションする色素の数（省略時は色数）。MarbleSimulation を色数より多い色素で
+             使っているときは同じ数にすると、その模様の縮小版になる。
+    """
+    if colors is None:
+        colors = DEFAULT_COLORS
+    if num_dyes is None:
+        num_dyes = len(colors)
+    
+    images = []
+    for seed in seeds:
+        simulation = MarbleSimulation(
+            width=width,
+            height=height,
+            iterations=iterations,
+            speed=speed,
+            diffusion_rate=diffusion_rate,
+            viscosity=viscosity,
+            seed=seed,
+            num_dyes=num_dyes,
+            vortex_count=vortex_count,
+            vortex_strength=vortex_strength,
+            dtype=dtype,
+            periodic=periodic,
+            n_threads=n_threads,
+            progress=progress
+        )
+        simulation.coarsen(pyramid)
+        simulation.step(iterations)
+        # テクスチャもシードの乱数の続きから引くので、同じシードの create_enhanced_marble と同じ画像になる
+        images.append(simulation.snapshot(colors, texture_seed=simulation.rng))
+    if not images:
+        raise ValueError("シードを1つ以上指定してください")
+    
+    # 一覧の画像に並べる
+    if columns is None:
+        columns = int(np.ceil(np.sqrt(len(images))))
+    rows = -(-len(images) // columns)
+    thumb_width, thumb_height = images[0].size
+    grid = Image.new("RGB", (columns * thumb_width + (columns - 1) * gap,
+                             rows * thumb_height + (rows - 1) * gap), (255, 255, 255))
+    for index, image in enumerate(images):
+        row, column = divmod(index, columns)
+        grid.paste(image, (column * (thumb_width + gap), row * (thumb_height + gap)))
+    
+    return grid, images
+
+def iter_marble_frames(width=800, height=600, iterations=100, speed=0.8,
+                       diffusion_rate=0.12, viscosity=0.35, seed=None,
+                       colors=None, vortex_count=None, vortex_strength=None,
+                       dtype=np.float32, every=5):
+    """
+    マーブル模様が混ざっていく様子を、every 回の反復ごとに1枚ずつ返すジェネレータ
+    シミュレーションは1回だけ進めるので、反復回数を変えて何度も生成するより計算量がずっと少ない。
+    最後の反復が every で割り切れないときも、最終状態のフレームを必ず返す。
+    """
+    if colors is None:
+        colors = DEFAULT_COLORS
     
-    # テクスチャを乗算モードで適用
-    texture_image = texture_image.convert('L')
-    pil_image = Image.composite(
-        pil_image, 
-        Image.new('RGB', pil_image.size, (255, 255, 255)),
-        ImageEnhance.Contrast(texture_image).enhance(0.1)
+    simulation = MarbleSimulation(
+        width=width,
+        height=height,
+        iterations=iterations,
+        speed=speed,
+        diffusion_rate=diffusion_rate,
+        viscosity=viscosity,
+        seed=seed,
+        num_dyes=len(colors),
+        vortex_count=vortex_count,
+        vortex_strength=vortex_strength,
+        dtype=dtype
     )
+    # フレームごとにテクスチャが変わってちらつかないよう、全フレームで同じテクスチャを使う
+    texture_seed = int(simulation.rng.integers(0, 2**31))
+    
+    while simulation.iteration < iterations:
+        simulation.step(min(every, iterations - simulation.iteration))
+        yield simulation.snapshot(colors, texture_seed=texture_seed)
+
+class _WebPAnimationWriter:
+    """
+    受け取ったフレームを1枚ずつ WebP にエンコードし、アニメーション WebP のファイルに追記していくライター
+    Pillow のアニメーション WebP の保存は全フレームを受け取ってからエンコードするので、フレームごとに
+    公開 API（Image.save の WEBP）で1枚の WebP にして、その画像データを ANMF チャンクとして書き出す。
+    ファイルの形式は WebP コンテナの仕様（RIFF / VP8X / ANIM / ANMF）どおり。各フレームは差分を取らない全画面のフレームになる。
+    """
+    def __init__(self, filepath, duration=100, loop=0, **save_options):
+        self.fp = open(filepath, "wb")
+        self.duration = duration
+        self.loop = loop
+        self.save_options = save_options
+        self.count = 0
+    
+    @staticmethod
+    def _chunk(chunk_type, data):
+        # チャンクの長さが奇数なら 0 で埋めて偶数にそろえる
+        return chunk_type + struct.pack("<I", len(data)) + data + b"\0" * (len(data) % 2)
+    
+    def write(self, frame):
+        encoded = io.BytesIO()
+        frame.save(encoded, format="WEBP", **self.save_options)
+        encoded = encoded.getvalue()
+        
+        # 1枚の WebP のチャンクのうち、画像データ（ALPH / VP8 / VP8L）だけを取り出す
+        image_data = b""
+        offset = 12
+        while offset < len(encoded):
+            chunk_type = encoded[offset:offset + 4]
+            size = struct.unpack("<I", encoded[offset + 4:offset + 8])[0]
+            end = offset + 8 + size + size % 2
+            if chunk_type in (b"ALPH", b"VP8 ", b"VP8L"):
+                image_data += encoded[offset:end]
+            offset = end
+        
+        width, height = frame.size
+        if self.count == 0:
+            # RIFF の大きさは close で書き直す。VP8X はアニメーションのフラグとキャンバスの大きさ
+            self.fp.write(b"RIFF\0\0\0\0WEBP")
+            self.fp.write(self._chunk(b"VP8X", struct.pack("<I", 0x02) + (width - 1).to_bytes(3, "little") +
+                                      (height - 1).to_bytes(3, "little")))
+            self.fp.write(self._chunk(b"ANIM", struct.pack("<IH", 0, self.loop)))
+        
+        # フレームの位置 (0, 0)・大きさ・表示時間（ミリ秒）、重ね合わせない（前のフレームを上書きする）
+        header = (b"\0" * 6 + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little") +
+                  self.duration.to_bytes(3, "little") + b"\x02")
+        self.fp.write(self._chunk(b"ANMF", header + image_data))
+        self.count += 1
+    
+    def close(self):
+        """RIFF の大きさを書き込んで閉じる。1枚も書いていなければ（途中で失敗したときなど）ファイルを消す"""
+        if self.count == 0:
+            self.fp.close()
+            os.remove(self.fp.name)
+            return
+        size = self.fp.tell()
+        self.fp.seek(4)
+        self.fp.write(struct.pack("<I", size - 8))
+        self.fp.close()
+
+def _write_gif_stream(frames, filepath, duration, loop):
+    """
+    フレームを1枚ずつ減色して GIF に書き出す（各フレームに専用のパレットを持たせる）
+    Pillow の公開関数 GifImagePlugin.getheader / getdata を使う（Pillow 12.3 で確認）。書き出したフレーム数を返す。
+    """
+    from PIL import GifImagePlugin
+    
+    count = 0
+    with open(filepath, "wb") as fp:
+        for frame in frames:
+            frame = frame.quantize()
+            if count == 0:
+                header, _ = GifImagePlugin.getheader(frame, info={"loop": loop, "duration": duration})
+                fp.write(b"".join(header))
+            fp.write(b"".join(GifImagePlugin.getdata(frame, duration=duration, include_color_table=True)))
+            count += 1
+        fp.write(b";")
+    return count
+
+def export_marble_animation(path, every=5, duration=100, loop=0, **kwargs):
+    """
+    マーブル模様が混ざっていく様子をアニメーションとして保存する
+    path の拡張子が .webp / .gif ならアニメーション画像、それ以外はフォルダとみなして
+    frame_0000.png から始まる連番 PNG を書き出す。
+    フレームは iter_marble_frames から1枚ずつ受け取って書き出すので、全フレームをメモリに溜めない。
+    kwargs は iter_marble_frames にそのまま渡す。保存したフレーム数を返す。
+    """
+    # フレームが1枚もないアニメーションは作れない（every が 0 以下だとシミュレーションが進まない）
+    if kwargs.get("iterations", 100) < 1:
+        raise ValueError(f"iterations は1以上にしてください: {kwargs['iterations']!r}")
+    if every < 1:
+        raise ValueError(f"every は1以上にしてください: {every!r}")
+    frames = iter_marble_frames(every=every, **kwargs)
+    extension = os.path.splitext(path)[1].lower()
+    
+    if extension == ".webp":
+        writer = _WebPAnimationWriter(path, duration=duration, loop=loop)
+        try:
+            for frame in frames:
+                writer.write(frame)
+        finally:
+            writer.close()
+        return writer.count
+    
+    if extension == ".gif":
+        return _write_gif_stream(frames, path, duration, loop)
+    
+    os.makedirs(path, exist_ok=True)
+    count = 0
+    for count, frame in enumerate(frames, start=1):
+        frame.save(os.path.join(path, f"frame_{count - 1:04d}.png"))
+    return count
+
+def _gaussian_radius(sigma):
+    """gaussian_filter（truncate=4.0）が参照する片側のピクセル数"""
+    return int(4.0 * sigma + 0.5)
+
+class _PNGStreamWriter:
+    """
+    上から順に受け取った行の帯を、そのまま圧縮して書き出す PNG ライター
+    画像全体をメモリに置かずに大きな PNG を保存するために使う（8bit RGB、Sub フィルタ）。
+    """
+    def __init__(self, filepath, width, height, compress_level=6):
+        self.width = width
+        self.fp = open(filepath, "wb")
+        self.compressor = zlib.compressobj(compress_level)
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    
+    def _write_chunk(self, chunk_type, data):
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+    
+    def write(self, rows):
+        """(行数, 幅, 3) の uint8 配列を書き出す"""
+        rows = rows.reshape(len(rows), self.width * 3)
+        # Sub フィルタ（左隣の画素との差。uint8 の引き算は 256 で折り返す）
+        filtered = np.empty((len(rows), 1 + self.width * 3), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = rows[:, :3]
+        np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self._write_chunk(b"IDAT", data)
+    
+    def close(self):
+        self._write_chunk(b"IDAT", self.compressor.flush())
+        self._write_chunk(b"IEND", b"")
+        self.fp.close()
+
+class TiledMarbleSimulation(_MarbleState):
+    """
+    状態を np.memmap のファイルに置き、タイルごとに処理するマーブル模様のシミュレーション
+    印刷用の大きな画像向けで、メモリ使用量は画像の大きさではなくタイルの大きさと色数で決まる。
+    各タイルは「1反復の最大移動量」と「ガウシアンフィルタの半径」の分だけ周りを余分に読んで計算するので、
+    結果は MarbleSimulation と同じになる。
+    MarbleSimulation とは初期状態の作り方だけを共有する別のクラスで、ピラミッドモード（coarsen/refine）・
+    周期境界・収束による打ち切り・スレッド・save/load はない。
+    workdir を省略すると一時フォルダを使い、close() で削除する。
+    """
+    def __init__(self, width=800, height=600, iterations=100, speed=0.8,
+                 diffusion_rate=0.12, viscosity=0.35, seed=None,
+                 num_dyes=16, vortex_count=None, vortex_strength=None,
+                 dtype=np.float32, tile_size=512, workdir=None, progress=None):
+        self.tile_size = tile_size
+        self._tempdir = None
+        if workdir is None:
+            self._tempdir = tempfile.TemporaryDirectory(prefix="marble_")
+            workdir = self._tempdir.name
+        os.makedirs(workdir, exist_ok=True)
+        self.workdir = workdir
+        
+        super().__init__(
+            width=width,
+            height=height,
+            iterations=iterations,
+            speed=speed,
+            diffusion_rate=diffusion_rate,
+            viscosity=viscosity,
+            seed=seed,
+            num_dyes=num_dyes,
+            vortex_count=vortex_count,
+            vortex_strength=vortex_strength,
+            dtype=dtype,
+            progress=progress
+        )
+        
+        # 反復の書き込み先（読み込み元と入れ替えながら使う）
+        dtype = self.dye_fields.dtype
+        self._velocity_next = (
+            self._zeros("velocity_x_next", (height, width), dtype),
+            self._zeros("velocity_y_next", (height, width), dtype),
+        )
+        self._dye_next = self._zeros("dye_fields_next", (num_dyes, height, width), dtype)
+        # 周りを広げたタイルの大きさ (高さ, 幅) ごとの色素の移流の計画
+        # 大きさは画像の端かどうかで決まるので、拡散の半径が同じ間は高々9通り（上下左右の端・角・内側）
+        self._plans = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        """memmap を手放し、一時フォルダを使っていれば削除する"""
+        self.velocity_x = self.velocity_y = None
+        self.force_field_x = self.force_field_y = None
+        self.dye_fields = self._dye_next = self._velocity_next = None
+        self._plans = {}
+        if self._tempdir is not None:
+            self._tempdir.cleanup()
+            self._tempdir = None
+    
+    def _zeros(self, name, shape, dtype):
+        """状態を workdir 内の memmap ファイルに確保する（新規ファイルは 0 で埋まっている）"""
+        return np.memmap(os.path.join(self.workdir, f"{name}.dat"), dtype=dtype, mode="w+", shape=shape)
+    
+    def _tiles(self, halo=0):
+        """
+        タイルごとに (中心の範囲, 周りを広げた範囲) を返す
+        範囲は (上端, 下端, 左端, 右端)。広げた範囲は画像の端で切り詰める。
+        """
+        for top in range(0, self.height, self.tile_size):
+            bottom = min(top + self.tile_size, self.height)
+            for left in range(0, self.width, self.tile_size):
+                right = min(left + self.tile_size, self.width)
+                yield (top, bottom, left, right), self._expand((top, bottom, left, right), halo)
+    
+    def _remove(self, name):
+        """_zeros で作った作業用のファイルを削除する"""
+        os.remove(os.path.join(self.workdir, f"{name}.dat"))
     
-    # 最終的な微調整
-    pil_image = pil_image.filter(ImageFilter.SMOOTH_MORE)
+    def _expand(self, box, halo):
+        top, bottom, left, right = box
+        return (max(0, top - halo), min(self.height, bottom + halo),
+                max(0, left - halo), min(self.width, right + halo))
     
-    return pil_image
+    def _add_force_noise(self, force_field, sigma, speed, scale):
+        """なめらかなランダムの力を、乱数の生成もぼかしもタイル単位で力場に足し込む"""
+        # 乱数は全画面で一度に生成した場合と同じ順序で、行の帯ごとに生成する
+        noise = self._zeros("noise", force_field.shape, force_field.dtype)
+        for top in range(0, self.height, self.tile_size):
+            bottom = min(top + self.tile_size, self.height)
+            noise[top:bottom] = self.rng.random((bottom - top, self.width)).astype(noise.dtype) * 2 - 1
+        
+        for (top, bottom, left, right), (y0, y1, x0, x1) in self._tiles(_gaussian_radius(sigma)):
+            smoothed = gaussian_filter(np.array(noise[y0:y1, x0:x1]), sigma=sigma)
+            force_field[top:bottom, left:right] += smoothed[top - y0:bottom - y0, left - x0:right - x0] * speed * scale
+        del noise
+        self._remove("noise")
+    
+    def step(self, n=1):
+        """シミュレーションを n 回進める（速度場と色素場をタイルごとに更新する）"""
+        iterations = self.iterations
+        size = (self.height, self.width)
+        
+        for i in range(self.iteration, self.iteration + n):
+            # 速度場を更新（徐々に減衰させてから、拡散でスムージング）
+            decay_factor = 0.95 if i > iterations // 2 else 0.98
+            max_speed = 0.0
+            velocity_next = self._velocity_next
+            for (top, bottom, left, right), (y0, y1, x0, x1) in self._tiles(_gaussian_radius(self.viscosity)):
+                for velocity, force_field, output in zip((self.velocity_x, self.velocity_y),
+                                                         (self.force_field_x, self.force_field_y),
+                                                         velocity_next):
+                    tile = np.array(velocity[y0:y1, x0:x1])
+                    tile *= decay_factor
+                    tile += force_field[y0:y1, x0:x1]
+                    gaussian_filter(tile, sigma=self.viscosity, output=tile)
+                    tile = tile[top - y0:bottom - y0, left - x0:right - x0]
+                    output[top:bottom, left:right] = tile
+                    max_speed = max(max_speed, float(np.abs(tile).max()))
+            self._velocity_next = (self.velocity_x, self.velocity_y)
+            self.velocity_x, self.velocity_y = velocity_next
+            
+            # 拡散（シミュレーション後半は拡散を抑える）
+            diffusion = self.diffusion_rate
+            if i > iterations * 0.7:
+                diffusion *= 0.8
+            
+            # 色素の移流と拡散
+            # 拡散のぼかしに必要な分だけ広げた範囲を移流させ、補間元はさらに最大移動量の分だけ広げて読む
+            # 移流の計画（色数 × タイルの大きさのバッファ）はタイルの大きさごとに1回だけ作って使い回す
+            reach = int(np.ceil(max_speed)) + 1
+            for (top, bottom, left, right), (y0, y1, x0, x1) in self._tiles(_gaussian_radius(diffusion)):
+                sy0, sy1, sx0, sx1 = self._expand((y0, y1, x0, x1), reach)
+                shape = (y1 - y0, x1 - x0)
+                plan = self._plans.get(shape)
+                if plan is None:
+                    plan = self._plans[shape] = AdvectionPlan(shape[0], shape[1], self.num_dyes,
+                                                              dtype=self.dye_fields.dtype)
+                plan.update(
+                    np.array(self.velocity_x[y0:y1, x0:x1]),
+                    np.array(self.velocity_y[y0:y1, x0:x1]),
+                    origin=(y0, x0),
+                    source=(sy0, sx0, sy1 - sy0, sx1 - sx0),
+                    image_size=size
+                )
+                dye_field_new = plan.apply(np.array(self.dye_fields[:, sy0:sy1, sx0:sx1]))
+                gaussian_filter(dye_field_new, sigma=(0, diffusion, diffusion), output=dye_field_new)
+                self._dye_next[:, top:bottom, left:right] = dye_field_new[:, top - y0:bottom - y0, left - x0:right - x0]
+            self.dye_fields, self._dye_next = self._dye_next, self.dye_fields
+            self.iteration += 1
+            if self.progress is not None:
+                self.progress(self.iteration, iterations)
+        
+        return self
+    
+    def _composite_bands(self, colors, texture_seed=None):
+        """
+        composite_marble と同じ合成をタイルごとに行い、上から順に行の帯 (行数, 幅, 3) を返すジェネレータ
+        コントラストの調整に使う画像全体の明るさの平均は、先に全タイルを1回なめて求めておく。
+        """
+        height, width = self.height, self.width
+        dtype = self.dye_fields.dtype
+        # 合成中は移流の計画を使わないので手放す（次の step で作り直す）
+        self._plans = {}
+        
+        # 微細なテクスチャの乱数（全画面で一度に生成した場合と同じ順序で、行の帯ごとに生成する）
+        rng = np.random.default_rng(texture_seed)
+        texture_noise = self._zeros("texture_noise", (height, width), dtype)
+        for top in range(0, height, self.tile_size):
+            bottom = min(top + self.tile_size, height)
+            texture_noise[top:bottom] = rng.random((bottom - top, width)).astype(dtype) * 10 - 5
+        
+        # 1回目：色を重ねた画像とテクスチャを作り、それぞれの合計を集める
+        texture = self._zeros("texture", (height, width), np.uint8)
+        blended = self._zeros("blended", (height, width, 3), np.uint8)
+        texture_sum = 0
+        channel_sums = np.zeros(3, dtype=np.int64)
+        for (top, bottom, left, right), (y0, y1, x0, x1) in self._tiles(_gaussian_radius(0.5)):
+            smoothed = gaussian_filter(np.array(texture_noise[y0:y1, x0:x1]), sigma=0.5)
+            smoothed = smoothed[top - y0:bottom - y0, left - x0:right - x0]
+            texture_tile = np.uint8(np.clip(smoothed + 128, 0, 255))
+            texture[top:bottom, left:right] = texture_tile
+            texture_sum += int(texture_tile.sum(dtype=np.int64))
+            
+            image_tile = _blend_dyes(np.array(self.dye_fields[:, top:bottom, left:right]), colors)
+            blended[top:bottom, left:right] = image_tile
+            channel_sums += image_tile.reshape(-1, 3).sum(axis=0, dtype=np.int64)
+        del texture_noise
+        self._remove("texture_noise")
+        
+        # コントラストの基準になる平均（composite_marble と同じ計算）
+        image_mean = float(channel_sums @ _LUMA_WEIGHTS) / (height * width)
+        texture_mean = float(texture_sum) / (height * width)
+        
+        # 2回目：仕上げ（SMOOTH_MORE は 5×5 なので周りを2ピクセル広げて処理する）
+        band = np.empty((min(self.tile_size, height), width, 3), dtype=np.uint8)
+        for (top, bottom, left, right), (y0, y1, x0, x1) in self._tiles(2):
+            finished = _finish_marble(
+                np.array(blended[y0:y1, x0:x1]),
+                np.array(texture[y0:y1, x0:x1]),
+                image_mean,
+                texture_mean
+            )
+            band[:bottom - top, left:right] = finished[top - y0:bottom - y0, left - x0:right - x0]
+            if right == width:
+                yield band[:bottom - top]
+        del texture, blended
+        self._remove("texture")
+        self._remove("blended")
+    
+    def snapshot(self, colors, texture_seed=None):
+        """現在の色素場をタイルごとに合成した PIL 画像を返す（画像そのものはメモリに置く）"""
+        image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        top = 0
+        for band in self._composite_bands(colors, texture_seed):
+            image[top:top + len(band)] = band
+            top += len(band)
+        return Image.fromarray(image)
+    
+    def save_png(self, filepath, colors, texture_seed=None):
+        """現在の色素場をタイルごとに合成し、画像全体をメモリに置かずに PNG として書き出す"""
+        writer = _PNGStreamWriter(filepath, self.width, self.height)
+        try:
+            for band in self._composite_bands(colors, texture_seed):
+                writer.write(band)
+        finally:
+            writer.close()
+
+def render_marble_tiled(filepath, width=8000, height=6000, iterations=100, speed=0.8,
+                        diffusion_rate=0.12, viscosity=0.35, seed=None,
+                        colors=None, vortex_count=None, vortex_strength=None,
+                        dtype=np.float32, tile_size=512, workdir=None, progress=None):
+    """
+    印刷用の大きなマーブル模様を、状態をディスク（memmap）に置いたままタイルごとに生成して PNG に書き出す
+    同じ引数の create_enhanced_marble と同じ画像になる。workdir には色数 × 2 + 6 枚分の全画面配列のファイルができる。
+    progress を渡すと1反復ごとに progress(済んだ反復回数, iterations) で呼ばれる。
+    """
+    if colors is None:
+        colors = DEFAULT_COLORS
+    
+    with TiledMarbleSimulation(
+        width=width,
+        height=height,
+        iterations=iterations,
+        speed=speed,
+        diffusion_rate=diffusion_rate,
+        viscosity=viscosity,
+        seed=seed,
+        num_dyes=len(colors),
+        vortex_count=vortex_count,
+        vortex_strength=vortex_strength,
+        dtype=dtype,
+        tile_size=tile_size,
+        workdir=workdir,
+        progress=progress
+    ) as simulation:
+        simulation.step(iterations)
+        # create_enhanced_marble と同じく、テクスチャもシミュレーションの Generator の続きから引く
+        simulation.save_png(filepath, colors, texture_seed=simulation.rng)
 
 # カラーパレットの定義
 COLOR_PALETTES = {
@@ -356,6 +1616,47 @@ COLOR_PALETTES = {
     ],
 }
 
+# 鮮やかな色のパレット（アプリで COLOR_PALETTES に追加して使う）
+VIBRANT_COLORS = {
+    "vibrant_blue": [
+        (255, 255, 255),      # 白
+        (240, 248, 255),      # アリスブルー
+        (135, 206, 250),      # ライトスカイブルー
+        (30, 144, 255),       # ドジャーブルー
+        (0, 191, 255),        # ディープスカイブルー
+        (0, 123, 255),        # 鮮やかな青
+        (0, 0, 255),          # 純青
+    ],
+    "vibrant_teal": [
+        (255, 255, 255),      # 白
+        (224, 255, 255),      # ライトシアン
+        (127, 255, 212),      # アクアマリン
+        (64, 224, 208),       # ターコイズ
+        (0, 255, 255),        # シアン
+        (0, 206, 209),        # ダークターコイズ
+        (0, 139, 139),        # ダークシアン
+    ],
+    "vibrant_pink": [
+        (255, 255, 255),      # 白
+        (255, 240, 245),      # ラベンダーブラッシュ
+        (255, 192, 203),      # ピンク
+        (255, 105, 180),      # ホットピンク
+        (255, 20, 147),       # ディープピンク
+        (219, 112, 147),      # ペールバイオレットレッド
+        (199, 21, 133),       # メディアムバイオレットレッド
+    ],
+    "rainbow": [
+        (255, 255, 255),      # 白
+        (255, 0, 0),          # 赤
+        (255, 165, 0),        # オレンジ
+        (255, 255, 0),        # 黄
+        (0, 255, 0),          # 緑
+        (0, 0, 255),          # 青
+        (75, 0, 130),         # インディゴ
+        (238, 130, 238),      # バイオレット
+    ],
+}
+
 # マーブルパターンの生成設定
 MARBLE_VARIANTS = {
     "standard": {
@@ -400,21 +1701,354 @@ MARBLE_VARIANTS = {
     },
 }
 
-def generate_marble_variants(output_dir="marbles", width=800, height=600, thumbnails=True):
+# カタログのシード導出方式（変更するとカタログのすべてのシードが変わる）
+SEED_DERIVATION = {
+    "method": "blake2b",
+    "key": "marble-catalog",
+    "version": 1,
+}
+
+def derive_seed(palette_name, variant_name, index):
+    """
+    パレット名・バリエーション名・番号からシードを導出する
+    hash() と違ってプロセスや実行ごとに値が変わらないので、前回の出力を再利用できる
+    """
+    digest = hashlib.blake2b(
+        f"{palette_name}_{variant_name}_{index}".encode("utf-8"),
+        key=SEED_DERIVATION["key"].encode("utf-8"),
+        digest_size=8,
+    ).digest()
+    return int.from_bytes(digest, "big") % 2**32
+
+# 生成アルゴリズムのバージョン（同じパラメータでも出力が変わる変更をしたら上げる）
+GENERATOR_VERSION = 3
+
+def marble_content_hash(colors, params, seed, width, height):
+    """
+    マーブル画像の内容を決めるすべての条件（色・パラメータ・シード・解像度・生成器のバージョン・
+    サムネイルの縮小方法）のハッシュ
+    値が同じなら同じ画像になるので、カタログの差分生成に使う
+    """
+    content = {
+        "colors": [list(color) for color in colors],
+        "params": params,
+        "seed": seed,
+        "width": width,
+        "height": height,
+        "generator_version": GENERATOR_VERSION,
+        # サムネイルの画素と大きさは縮小の方法で変わる（Image.reduce は端数を切り上げる）
+        "thumbnail_reduce": THUMBNAIL_REDUCE,
+    }
+    encoded = json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+class SimulationCache:
+    """
+    シミュレーション結果（MarbleSimulation）のキャッシュ
+    よく使う結果はメモリ上の LRU に max_entries 個まで置き、あふれたものは directory に .npz で書き出して
+    max_disk_entries 個まで残す。キーはパラメータを正規化した内容のハッシュで、生成器のバージョンも含む。
+    複数のスレッド（Streamlit のセッション）から同時に使える。取り出した結果は呼び出し側で自由に進めてよい。
+    シードを指定しない（毎回違う模様になる）パラメータは保存しない。
+    """
+    def __init__(self, directory=None, max_entries=8, max_disk_entries=64):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+    
+    @staticmethod
+    def key(params):
+        """パラメータの辞書を正規化してハッシュにする（スライダーの浮動小数点の誤差は丸める）"""
+        normalized = {}
+        for name, value in params.items():
+            if isinstance(value, (bool, np.bool_)):
+                value = bool(value)
+            elif isinstance(value, (int, np.integer)):
+                value = int(value)
+            elif isinstance(value, (float, np.floating)):
+                value = round(float(value), 6)
+            normalized[name] = value
+        content = {"params": normalized, "generator_version": GENERATOR_VERSION}
+        encoded = json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+    
+    def get(self, params):
+        """キャッシュにあれば結果のコピーを、なければ None を返す"""
+        if params.get("seed") is None:
+            return None
+        key = self.key(params)
+        with self._lock:
+            simulation = self._entries.get(key)
+            if simulation is not None:
+                self._entries.move_to_end(key)
+                return copy.deepcopy(simulation)
+        
+        # メモリになければディスクから読み込み、よく使うものとしてメモリに戻す
+        if self.directory is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            simulation = MarbleSimulation.load(self._path(key))
+        except (OSError, ValueError, KeyError):
+            return None
+        self._store(key, simulation)
+        return copy.deepcopy(simulation)
+    
+    def put(self, params, simulation):
+        """結果のコピーを保存する（シードのないパラメータは保存しない）"""
+        if params.get("seed") is None:
+            return
+        # コールバックはコピーせずに外す（ロックなどコピーできないものを持っていることがある）
+        callbacks = simulation.on_phase, simulation.progress
+        simulation.on_phase = simulation.progress = None
+        try:
+            copied = copy.deepcopy(simulation)
+        finally:
+            simulation.on_phase, simulation.progress = callbacks
+        self._store(self.key(params), copied)
+    
+    def _store(self, key, simulation):
+        with self._lock:
+            self._entries[key] = simulation
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False))
+        for evicted_key, evicted_simulation in evicted:
+            self._spill(evicted_key, evicted_simulation)
+    
+    def _spill(self, key, simulation):
+        """メモリからあふれた結果をディスクに書き出し、古いファイルを消して件数を抑える"""
+        if self.directory is None:
+            return
+        path = self._path(key)
+        if not os.path.exists(path):
+            # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+            temp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+            simulation.save(temp_path)
+            os.replace(temp_path, path)
+        os.utime(path)
+        
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")]
+        files = [path for path in files if not path.endswith(".tmp.npz")]
+        if len(files) > self.max_disk_entries:
+            files.sort(key=os.path.getmtime)
+            for old_path in files[:len(files) - self.max_disk_entries]:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+class RenderCancelled(Exception):
+    """バックグラウンドの生成が中断されたことを表す例外"""
+
+class _RenderJob:
+    """RenderJobQueue の1つのジョブ（進み具合と中断の合図を持つ）"""
+    def __init__(self, total):
+        self.id = uuid.uuid4().hex
+        self.done = 0
+        self.total = total
+        self.cancelled = threading.Event()
+        self.last_seen = time.monotonic()
+        self.future = None
+    
+    def report(self, done, total):
+        """progress コールバック。中断の合図があれば RenderCancelled を送出して計算を止める"""
+        if self.cancelled.is_set():
+            raise RenderCancelled()
+        self.done = done
+        self.total = total
+    
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+class RenderJobQueue:
+    """
+    マーブル模様の生成をバックグラウンドのスレッドで実行するジョブの管理
+    submit(function) は function(progress) をワーカーで実行してジョブ ID を返す。
+    progress(済んだ反復回数, 全体) は MarbleSimulation や create_enhanced_marble の progress にそのまま渡せる。
+    poll(job_id) で進み具合を、result(job_id) で結果を受け取る。
+    abandon_after 秒以上 poll されないジョブは放棄されたとみなして中断し、ワーカーを空ける。
+    """
+    def __init__(self, max_workers=2, abandon_after=30.0):
+        self.abandon_after = abandon_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="marble_render")
+        self._jobs = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, function, total=None):
+        """function(progress) を実行するジョブを登録し、ジョブ ID を返す"""
+        self._reap()
+        job = _RenderJob(total)
+        with self._lock:
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(function, job.report)
+        return job.id
+    
+    def poll(self, job_id):
+        """
+        ジョブの状態 {"done", "total", "finished"} を返す（知らないジョブ ID なら None）
+        poll するたびに、そのジョブはまだ使われているものとして放棄の判定を先に延ばす。
+        """
+        self._reap()
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job.last_seen = time.monotonic()
+        return {"done": job.done, "total": job.total, "finished": job.future.done()}
+    
+    def result(self, job_id):
+        """
+        終わったジョブの結果を返して登録を消す
+        中断されたジョブなら RenderCancelled を、function が例外で終わったならその例外を送出する。
+        """
+        with self._lock:
+            job = self._jobs.pop(job_id)
+        try:
+            return job.future.result()
+        except CancelledError:
+            raise RenderCancelled()
+    
+    def cancel(self, job_id):
+        """ジョブを中断して登録を消す（まだ始まっていなければ実行しない）"""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.cancel()
+    
+    def _reap(self):
+        """しばらく poll されていないジョブを中断して登録を消す"""
+        now = time.monotonic()
+        with self._lock:
+            abandoned = [job_id for job_id, job in self._jobs.items() if now - job.last_seen > self.abandon_after]
+            jobs = [self._jobs.pop(job_id) for job_id in abandoned]
+        for job in jobs:
+            job.cancel()
+
+# カタログの画像の保存形式（拡張子, Pillow の形式名, 保存オプション）
+# 800x600 で測ると、PNG の compress_level=3 は既定の 6 より約3倍速く、ファイルは1割ほど大きい。
+# 可逆 WebP の quality は圧縮の手間で、0 でも既定の 80 とほぼ同じ大きさのまま2倍以上速い。
+# JPEG は非可逆だが最も速く小さい。色の境目がにじまないように色差を間引かない（subsampling=0）。
+IMAGE_FORMATS = {
+    "png": ("png", "PNG", {"compress_level": 3}),
+    "webp": ("webp", "WEBP", {"lossless": True, "quality": 0}),
+    "jpeg": ("jpg", "JPEG", {"quality": 95, "subsampling": 0}),
+}
+
+# サムネイルの縮小率（Image.reduce で縦横を 1/4 にする）
+# 変えるとサムネイルが変わるので、marble_content_hash に含めて作り直させる
+THUMBNAIL_REDUCE = 4
+
+def _encode_image(image, filepath, image_format):
+    """画像を image_format（IMAGE_FORMATS のキー）で保存し、かかった時間（秒）と書き込んだバイト数を返す"""
+    _, pil_format, options = IMAGE_FORMATS[image_format]
+    start = time.perf_counter()
+    image.save(filepath, format=pil_format, **options)
+    return time.perf_counter() - start, os.path.getsize(filepath)
+
+def _save_marble_job(job, marble, encoder=None):
+    """
+    生成したマーブル画像とサムネイルを保存し、エンコードの時間とバイト数をメタデータに記録する
+    encoder（ThreadPoolExecutor）を渡すと画像とサムネイルを別々のスレッドでエンコードし、
+    呼び出し側が次の画像を生成している間に書き込む。戻り値は完了を待つための関数。
+    """
+    job["marble_info"]["iterations"] = marble.info["iterations"]
+    
+    # サムネイルは縮小前の画像を複製せず、Image.reduce で 4x4 画素の平均から直接作る（オプション）
+    images = [(marble, job["filepath"], "")]
+    if job["thumb_filepath"] is not None:
+        images.append((marble.reduce(THUMBNAIL_REDUCE), job["thumb_filepath"], "thumbnail_"))
+    
+    if encoder is None:
+        results = [_encode_image(image, filepath, job["image_format"]) for image, filepath, _ in images]
+    else:
+        futures = [encoder.submit(_encode_image, image, filepath, job["image_format"])
+                   for image, filepath, _ in images]
+    
+    def wait():
+        encoded = results if encoder is None else [future.result() for future in futures]
+        for (_, _, prefix), (seconds, size) in zip(images, encoded):
+            job["marble_info"][prefix + "bytes"] = size
+            job["encode_seconds"] += seconds
+        return job["marble_info"]
+    
+    return wait
+
+def _render_marble_job(job, encoder=None):
+    """
+    カタログ用のマーブル模様を1枚生成し、画像とサムネイルを保存する
+    ワーカープロセスからも呼ばれるので、必要な情報はすべて job に含める
+    encoder を渡すと保存はスレッドで行い、完了を待つ関数を返す（_save_marble_job を参照）。
+    """
+    # マーブル画像を生成
+    marble = create_enhanced_marble(
+        width=job["width"],
+        height=job["height"],
+        seed=job["seed"],
+        colors=job["colors"],
+        **job["params"]
+    )
+    
+    # 画像とサムネイルを保存
+    wait = _save_marble_job(job, marble, encoder)
+    if encoder is not None:
+        return wait
+    marble_info = wait()
+    return marble_info, job["encode_seconds"]
+
+def generate_marble_variants(output_dir="marbles", width=800, height=600, thumbnails=True, workers=1,
+                             skip_existing=True, tolerance=None, image_format="png", encode_workers=2):
     """
     様々なカテゴリとバリエーションのマーブル模様を生成し、
     指定したディレクトリに保存する
+    
+    workers: 2以上を指定すると、その数のプロセスで並列に生成する（結果は逐次実行と同じ）
+    skip_existing: 前回と同じ内容ハッシュで生成済みの画像は作り直さない（追加・変更された分だけ生成する）
+    tolerance: 指定すると色素場の変化が小さくなった時点で反復を打ち切る（create_enhanced_marble を参照）。
+               実際に行った反復回数はメタデータの各画像の "iterations" に記録する。
+    image_format: 画像とサムネイルの保存形式（"png"・可逆の "webp"・"jpeg"。IMAGE_FORMATS を参照）
+                  前回と違う形式にすると、同じ画像の別の形式のファイル（サムネイルも）は削除する。
+    thumbnails: False なら前回作ったサムネイルも削除する（メタデータの "thumbnail" は None になる）。
+    encode_workers: 逐次生成のとき、画像の保存（エンコード）に使うスレッドの数。
+                    次の画像を生成している間に前の画像を書き込む。workers が2以上なら各プロセスの中で保存する。
     """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"image_format は {', '.join(IMAGE_FORMATS)} のいずれかです: {image_format!r}")
+    extension = IMAGE_FORMATS[image_format][0]
+    
     # 出力ディレクトリの作成
     os.makedirs(output_dir, exist_ok=True)
     
     # メタデータを格納する辞書
     metadata = {
+        "catalog": {
+            "seed_derivation": SEED_DERIVATION,
+            "generator_version": GENERATOR_VERSION,
+            "width": width,
+            "height": height,
+            "thumbnails": thumbnails,
+            "image_format": image_format,
+        },
         "palettes": {},
         "variants": {},
         "marbles": []
     }
     
+    # 前回のメタデータ（画像ごとの内容ハッシュを比較して再利用する）
+    previous_marbles = {}
+    metadata_path = os.path.join(output_dir, "metadata.json")
+    if skip_existing and os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            previous = json.load(f)
+        previous_marbles = {marble["path"]: marble for marble in previous.get("marbles", [])}
+    
     # 各パレットの情報をメタデータに追加
     for palette_name, colors in COLOR_PALETTES.items():
         metadata["palettes"][palette_name] = {
@@ -431,73 +2065,164 @@ def generate_marble_variants(output_dir="marbles", width=800, height=600, thumbn
             "params": params
         }
     
-    # 各パレットとバリエーションの組み合わせに対して、異なるシードでいくつかの画像を生成
-    marble_count = 0
-    
-    # 進捗表示用
-    total_combinations = len(COLOR_PALETTES) * len(MARBLE_VARIANTS) * 5  # 各組み合わせで5つの画像
-    
-    with tqdm(total=total_combinations, desc="Generating marbles") as pbar:
-        for palette_name, colors in COLOR_PALETTES.items():
-            # パレット用のディレクトリを作成
-            palette_dir = os.path.join(output_dir, palette_name)
-            os.makedirs(palette_dir, exist_ok=True)
+    # 各パレットとバリエーションの組み合わせに対して、異なるシードでいくつかの画像の生成ジョブを作る
+    jobs = []
+    for palette_name, colors in COLOR_PALETTES.items():
+        for variant_name, params in MARBLE_VARIANTS.items():
+            # 打ち切りの基準も画像の内容を変えるので、パラメータに含めて内容ハッシュに反映させる
+            if tolerance is not None:
+                params = {**params, "tolerance": tolerance}
             
-            for variant_name, params in MARBLE_VARIANTS.items():
-                # バリエーション用のディレクトリを作成
-                variant_dir = os.path.join(palette_dir, variant_name)
-                os.makedirs(variant_dir, exist_ok=True)
+            # パレットとバリエーション用のディレクトリを作成
+            variant_dir = os.path.join(output_dir, palette_name, variant_name)
+            os.makedirs(variant_dir, exist_ok=True)
+            
+            # 各組み合わせでいくつかの異なるシードで生成
+            for i in range(5):  # 各パレット・バリエーションで5つのパターン
+                seed = derive_seed(palette_name, variant_name, i)
                 
-                # 各組み合わせでいくつかの異なるシードで生成
-                for i in range(5):  # 各パレット・バリエーションで5つのパターン
-                    seed = hash(f"{palette_name}_{variant_name}_{i}") % 10000
-                    
-                    # マーブル画像を生成
-                    marble = create_enhanced_marble(
-                        width=width,
-                        height=height,
-                        seed=seed,
-                        colors=colors,
-                        **params
-                    )
-                    
-                    # ファイル名の生成
-                    filename = f"marble_{palette_name}_{variant_name}_{i}.png"
-                    filepath = os.path.join(variant_dir, filename)
-                    
-                    # 画像を保存
-                    marble.save(filepath)
-                    
-                    # サムネイルを生成（オプション）
-                    if thumbnails:
-                        thumb_size = (width // 4, height // 4)
-                        thumbnail = marble.copy()
-                        thumbnail.thumbnail(thumb_size)
-                        thumb_filepath = os.path.join(variant_dir, f"thumb_{filename}")
-                        thumbnail.save(thumb_filepath)
-                    
+                # ファイル名の生成
+                filename = f"marble_{palette_name}_{variant_name}_{i}.{extension}"
+                filepath = os.path.join(variant_dir, filename)
+                thumb_filepath = os.path.join(variant_dir, f"thumb_{filename}") if thumbnails else None
+                
+                # 形式を切り替えたときや、サムネイルを作らなくしたときに、前回のファイルが残らないようにする
+                stale = [] if thumbnails else [f"thumb_{filename}"]
+                for other_extension, _, _ in IMAGE_FORMATS.values():
+                    if other_extension != extension:
+                        other_filename = f"marble_{palette_name}_{variant_name}_{i}.{other_extension}"
+                        stale += [other_filename, f"thumb_{other_filename}"]
+                for name in stale:
+                    stale_filepath = os.path.join(variant_dir, name)
+                    if os.path.exists(stale_filepath):
+                        os.remove(stale_filepath)
+                
+                path = f"{palette_name}/{variant_name}/{filename}"
+                content_hash = marble_content_hash(colors, params, seed, width, height)
+                
+                # 前回同じ内容で生成した画像が残っていれば作り直さない
+                previous_marble = previous_marbles.get(path, {})
+                done = (previous_marble.get("hash") == content_hash and
+                        os.path.exists(filepath) and
+                        (thumb_filepath is None or os.path.exists(thumb_filepath)))
+                
+                jobs.append({
+                    "width": width,
+                    "height": height,
+                    "seed": seed,
+                    "colors": colors,
+                    "params": params,
+                    "filepath": filepath,
+                    "thumb_filepath": thumb_filepath,
+                    "image_format": image_format,
+                    "encode_seconds": 0.0,
+                    "done": done,
                     # メタデータにこの画像の情報を追加
-                    marble_info = {
-                        "id": marble_count,
+                    "marble_info": {
+                        "id": len(jobs),
                         "filename": filename,
                         "palette": palette_name,
                         "variant": variant_name,
                         "seed": seed,
-                        "path": f"{palette_name}/{variant_name}/{filename}",
-                        "thumbnail": f"{palette_name}/{variant_name}/thumb_{filename}" if thumbnails else None
-                    }
-                    metadata["marbles"].append(marble_info)
-                    marble_count += 1
-                    
+                        "hash": content_hash,
+                        "path": path,
+                        "thumbnail": f"{palette_name}/{variant_name}/thumb_{filename}" if thumbnails else None,
+                        # 実際に行った反復回数（生成時に記録する。再利用する画像は前回の値）
+                        "iterations": previous_marble.get("iterations") if done else None,
+                        # 書き込んだバイト数（画像とサムネイル）
+                        "bytes": previous_marble.get("bytes") if done else None,
+                        "thumbnail_bytes": previous_marble.get("thumbnail_bytes") if done and thumbnails else None
+                    },
+                })
+    
+    # 未生成の画像だけを生成（メタデータはジョブの順に並べるので、並列でも逐次と同じになる）
+    pending = [job for job in jobs if not job["done"]]
+    start = time.perf_counter()
+    with tqdm(total=len(pending), desc="Generating marbles") as pbar:
+        if workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # ワーカーで記録した情報（反復回数・バイト数）とエンコードの時間を受け取る
+                for job, (marble_info, encode_seconds) in zip(pending, executor.map(_render_marble_job, pending)):
+                    job["marble_info"] = marble_info
+                    job["encode_seconds"] = encode_seconds
+                    pbar.update(1)
+        else:
+            # 保存待ちの画像がたまってメモリを使いすぎないように、encode_workers 枚を超えたら古いものから待つ
+            with ThreadPoolExecutor(max_workers=max(1, encode_workers)) as encoder:
+                waiting = []
+                for job in pending:
+                    waiting.append(_render_marble_job(job, encoder))
+                    while len(waiting) > encode_workers:
+                        waiting.pop(0)()
+                        pbar.update(1)
+                for wait in waiting:
+                    wait()
                     pbar.update(1)
+    elapsed = time.perf_counter() - start
+    
+    metadata["marbles"] = [job["marble_info"] for job in jobs]
+    marble_count = len(metadata["marbles"])
+    
+    # 今回保存した画像のエンコードの時間と書き込んだバイト数（メタデータには残さない）
+    encode_seconds = sum(job["encode_seconds"] for job in pending)
+    written_bytes = sum((job["marble_info"]["bytes"] or 0) + (job["marble_info"]["thumbnail_bytes"] or 0)
+                        for job in pending)
     
     # メタデータをJSONファイルとして保存
-    with open(os.path.join(output_dir, "metadata.json"), "w") as f:
+    with open(metadata_path, "w") as f:
         json.dump(metadata, f, indent=2)
     
-    print(f"生成完了! 合計 {marble_count} 個のマーブル模様が {output_dir} に保存されました")
+    print(f"生成完了! 合計 {marble_count} 個のマーブル模様が {output_dir} に保存されました"
+          f"（新規生成 {len(pending)} 個）")
+    if pending:
+        print(f"エンコード（{image_format}）: {encode_seconds:.2f} 秒（全体 {elapsed:.2f} 秒）, "
+              f"{written_bytes / 1e6:.1f} MB 書き込み")
     return metadata
 
+def profile_marble_variants(width=800, height=600, colors=None, variants=None):
+    """
+    各バリエーションを1枚ずつ PhaseProfiler 付きで生成し、フェーズごとの集計を返す
+    MARBLE_VARIANTS のパラメータを調整するときに、どのフェーズに時間とメモリがかかっているかを見る。
+    シードはバリエーションごとに derive_seed で固定するので、同じ引数なら同じ画像で比べられる。
+    """
+    if colors is None:
+        colors = DEFAULT_COLORS
+    if variants is None:
+        variants = MARBLE_VARIANTS
+    
+    report = {"width": width, "height": height, "num_colors": len(colors), "variants": {}}
+    for variant_name, params in variants.items():
+        with PhaseProfiler() as profiler:
+            marble = create_enhanced_marble(
+                width=width,
+                height=height,
+                seed=derive_seed("profile", variant_name, 0),
+                colors=colors,
+                on_phase=profiler,
+                **params
+            )
+        summary = profiler.summary()
+        summary["iterations"] = marble.info["iterations"]
+        report["variants"][variant_name] = summary
+    return report
+
 if __name__ == "__main__":
-    # 高品質なマーブル模様のバリエーションを生成
-    generate_marble_variants(output_dir="marbles", width=800, height=600, thumbnails=True)
\ No newline at end of file
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="マーブル模様のバリエーションを生成する")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--profile", nargs="?", const="profile.json", metavar="PATH",
+                        help="カタログは作らず、各バリエーションのフェーズごとの時間とメモリを JSON に書き出す")
+    parser.add_argument("--format", choices=list(IMAGE_FORMATS), default="png", help="カタログの画像の保存形式")
+    args = parser.parse_args()
+    
+    if args.profile:
+        report = profile_marble_variants(width=args.width, height=args.height)
+        with open(args.profile, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"プロファイル結果を {args.profile} に保存しました")
+    else:
+        # 高品質なマーブル模様のバリエーションを生成
+        generate_marble_variants(output_dir="marbles", width=args.width, height=args.height, thumbnails=True,
+                                 workers=os.cpu_count() or 1, image_format=args.format)
\ No newline at end of file
@@ -1,53 +1,135 @@
 import streamlit as st
-from marble_generator import create_enhanced_marble, COLOR_PALETTES
+from marble_generator import (
+    MarbleSimulation, SimulationCache, RenderJobQueue, RenderCancelled, create_marble_sweep,
+    COLOR_PALETTES, VIBRANT_COLORS
+)
 import numpy as np
 from PIL import Image, ImageEnhance
 import io
-
-# 鮮やかな色のパレットを追加
-VIBRANT_COLORS = {
-    "vibrant_blue": [
-        (255, 255, 255),      # 白
-        (240, 248, 255),      # アリスブルー
-        (135, 206, 250),      # ライトスカイブルー
-        (30, 144, 255),       # ドジャーブルー
-        (0, 191, 255),        # ディープスカイブルー
-        (0, 123, 255),        # 鮮やかな青
-        (0, 0, 255),          # 純青
-    ],
-    "vibrant_teal": [
-        (255, 255, 255),      # 白
-        (224, 255, 255),      # ライトシアン
-        (127, 255, 212),      # アクアマリン
-        (64, 224, 208),       # ターコイズ
-        (0, 255, 255),        # シアン
-        (0, 206, 209),        # ダークターコイズ
-        (0, 139, 139),        # ダークシアン
-    ],
-    "vibrant_pink": [
-        (255, 255, 255),      # 白
-        (255, 240, 245),      # ラベンダーブラッシュ
-        (255, 192, 203),      # ピンク
-        (255, 105, 180),      # ホットピンク
-        (255, 20, 147),       # ディープピンク
-        (219, 112, 147),      # ペールバイオレットレッド
-        (199, 21, 133),       # メディアムバイオレットレッド
-    ],
-    "rainbow": [
-        (255, 255, 255),      # 白
-        (255, 0, 0),          # 赤
-        (255, 165, 0),        # オレンジ
-        (255, 255, 0),        # 黄
-        (0, 255, 0),          # 緑
-        (0, 0, 255),          # 青
-        (75, 0, 130),         # インディゴ
-        (238, 130, 238),      # バイオレット
-    ],
-}
+import os
+import tempfile
 
 # 既存のパレットに追加
 all_palettes = {**COLOR_PALETTES, **VIBRANT_COLORS}
 
+# シミュレーションする色素の数（どのパレットにカスタムカラーを足しても足りる数）
+# 色素場を使い回して、パレットの切り替えは色の合成だけで済ませる
+NUM_DYES = max(len(colors) for colors in all_palettes.values()) + 1
+
+# バックグラウンドで同時に生成する模様の数（全セッション合計）
+RENDER_WORKERS = 2
+
+# 1枚の模様の色素を並行に計算するスレッドの数（プロセスを使わないので起動が速い）
+# RENDER_WORKERS 個の生成が同時に走ってもコア数を超えないように、コアを分け合う
+RENDER_THREADS = max(1, (os.cpu_count() or 1) // RENDER_WORKERS)
+
+# 生成中の進み具合を確認する間隔（秒）
+RENDER_POLL_SECONDS = 0.5
+
+# 「もっとまぜる」で追加する反復回数
+EXTEND_ITERATIONS = 20
+
+# 簡易プレビューで格子を粗くする倍率
+PREVIEW_PYRAMID = 4
+
+# シードを見比べる一覧に並べる模様の数
+GALLERY_SIZE = 9
+
+@st.cache_resource
+def get_simulation_cache():
+    """
+    全セッションで共有するシミュレーション結果のキャッシュ
+    同じシード・サイズ・流れのパラメータなら、別のセッションの結果でも使い回す。
+    """
+    return SimulationCache(os.path.join(tempfile.gettempdir(), "marble_simulation_cache"))
+
+@st.cache_resource
+def get_render_queue():
+    """
+    全セッションで共有するバックグラウンド生成のジョブ管理
+    ジョブ ID だけをセッションに置くので、生成中も画面を操作でき、次の再実行で結果を受け取れる。
+    """
+    return RenderJobQueue(max_workers=RENDER_WORKERS)
+
+def run_simulation(cache, params, pyramid=1, progress=None):
+    """
+    流れのパラメータでシミュレーションした MarbleSimulation を返す（キャッシュにあれば使い回す）
+    pyramid が2以上なら、格子を粗くしたまま全反復する簡易プレビュー用の結果になる。
+    バックグラウンドのスレッドからも呼ぶので、キャッシュは引数で受け取る。
+    """
+    cache_params = dict(params, num_dyes=NUM_DYES, pyramid=pyramid)
+    simulation = cache.get(cache_params)
+    if simulation is None:
+        simulation = MarbleSimulation(num_dyes=NUM_DYES, n_threads=RENDER_THREADS, progress=progress, **params)
+        simulation.coarsen(pyramid)
+        simulation.step(params["iterations"])
+        simulation.progress = None
+        cache.put(cache_params, simulation)
+    # ディスクから読み込んだ結果はスレッド数が 1 に戻っているので、「もっとまぜる」用に設定し直す
+    simulation.n_threads = RENDER_THREADS
+    return simulation
+
+def enhance_marble(image, saturation, contrast):
+    """彩度とコントラストを強化する（元の画像は変えずに新しい画像を返す）"""
+    # 彩度を上げる
+    image = ImageEnhance.Color(image).enhance(saturation)
+    # コントラストを上げる
+    return ImageEnhance.Contrast(image).enhance(contrast)
+
+def render_marble(cache, params, progress):
+    """バックグラウンドのジョブとして模様をシミュレーションし、(シミュレーション, テクスチャのシード) を返す"""
+    simulation = run_simulation(cache, params, progress=progress)
+    # テクスチャもシミュレーションの乱数の続きから決める（同じシードなら同じ画像になる）
+    return simulation, int(simulation.rng.integers(0, 2**31))
+
+def start_render(params):
+    """模様の生成をバックグラウンドのジョブとして始め、ジョブ ID をセッションに置く"""
+    queue = get_render_queue()
+    # 生成中の前のジョブは結果を使わないので中断してワーカーを空ける
+    if 'render_job_id' in st.session_state:
+        queue.cancel(st.session_state.render_job_id)
+    # マーブル模様の流れをバックグラウンドでシミュレーション（色付けは後で行う）
+    # シード固定なら、同じパラメータで誰かが生成した結果をキャッシュから使い回す
+    cache = get_simulation_cache()
+    params = dict(params)
+    st.session_state.render_job_id = queue.submit(
+        lambda progress: render_marble(cache, params, progress),
+        total=params["iterations"]
+    )
+    st.session_state.render_job_flow = params
+
+@st.fragment(run_every=RENDER_POLL_SECONDS)
+def show_render_progress():
+    """
+    生成中のジョブの進み具合を表示し、終わっていれば結果をセッションに取り込む
+    この部分だけが一定間隔で再実行されるので、生成中も他の設定を操作できる。
+    """
+    job_id = st.session_state.get('render_job_id')
+    if job_id is None:
+        return
+    queue = get_render_queue()
+    status = queue.poll(job_id)
+    if status is None:
+        # 長く放置されて中断されたジョブ
+        del st.session_state.render_job_id
+        return
+    if not status["finished"]:
+        st.progress(status["done"] / status["total"],
+                    text=f"模様を生成中... {status['done']} / {status['total']} 回")
+        return
+    
+    del st.session_state.render_job_id
+    try:
+        simulation, texture_seed = queue.result(job_id)
+    except RenderCancelled:
+        return
+    st.session_state.marble_simulation = simulation
+    st.session_state.marble_flow = st.session_state.render_job_flow
+    st.session_state.marble_texture_seed = texture_seed
+    st.session_state.marble_render_id = st.session_state.get('marble_render_id', 0) + 1
+    # 画像の表示を含めて画面全体を更新する
+    st.rerun()
+
 # セッション状態の初期化
 if 'recent_colors' not in st.session_state:
     st.session_state.recent_colors = []
@@ -263,6 +345,9 @@ if show_params:
                 if len(st.session_state.recent_colors) > 3:
                     st.session_state.recent_colors.pop()
 
+# 上下・左右の端がつながった（並べて使える）模様にするか
+periodic = False
+
 # 詳細設定
 if show_params:
     # スマホ表示に適した折りたたみメニュー
@@ -283,6 +368,8 @@ if show_params:
         height = height_cols[1].slider("", 200, 600, height, label_visibility="collapsed")
         if height_cols[2].button("+", key="height_plus"):
             height = min(600, height + 50)
+        
+        periodic = st.checkbox("つなぎ目のない模様にする（壁紙のように並べて使える）", periodic)
     
     with st.sidebar.expander("基本設定", expanded=False):
         iterations = st.slider("反復回数", 30, 150, iterations)
@@ -338,6 +425,20 @@ if add_custom_color and custom_color:
     b = int(custom_color[5:7], 16)
     colors.append((r, g, b))
 
+# 模様の流れを決めるパラメータ（色には依存しない）
+flow_params = dict(
+    width=width,
+    height=height,
+    iterations=iterations,
+    speed=speed,
+    diffusion_rate=diffusion_rate,
+    viscosity=viscosity,
+    seed=seed,
+    vortex_count=vortex_count,
+    vortex_strength=vortex_strength,
+    periodic=periodic
+)
+
 # 簡易プレビュー（オプション）
 preview_on = st.sidebar.checkbox("簡易プレビュー (低解像度)", False)
 if preview_on:
@@ -345,28 +446,23 @@ if preview_on:
         with st.sidebar:
             with st.spinner("プレビュー生成中..."):
                 # 軽量版のプレビュー画像を生成
-                preview_image = create_enhanced_marble(
-                    width=width//4,  # サイズを大幅に縮小
-                    height=height//4,
-                    iterations=max(30, iterations//2),  # 反復回数も減らす
-                    speed=speed,
-                    diffusion_rate=diffusion_rate,
-                    viscosity=viscosity,
-                    seed=seed,
-                    colors=colors,
-                    vortex_count=vortex_count,
-                    vortex_strength=vortex_strength
+                # 同じ設定・シードの本番の画像を 1/4 に縮めた近似になるよう、粗い格子で全反復を計算する
+                preview_simulation = run_simulation(get_simulation_cache(), flow_params, pyramid=PREVIEW_PYRAMID)
+                # 色彩の強化前の画像を残し、スライダーを動かしたら強化だけをやり直す
+                st.session_state.preview_raw = preview_simulation.snapshot(
+                    colors,
+                    texture_seed=int(preview_simulation.rng.integers(0, 2**31))
                 )
-                
-                # 彩度とコントラストを強化
-                if enhance_colors:
-                    enhancer = ImageEnhance.Color(preview_image)
-                    preview_image = enhancer.enhance(saturation)
-                    enhancer = ImageEnhance.Contrast(preview_image)
-                    preview_image = enhancer.enhance(contrast)
-                
-                # プレビューを表示
-                st.image(preview_image, caption="プレビュー", use_container_width=True)
+    
+    if 'preview_raw' in st.session_state:
+        preview_image = st.session_state.preview_raw
+        
+        # 彩度とコントラストを強化
+        if enhance_colors:
+            preview_image = enhance_marble(preview_image, saturation, contrast)
+        
+        # プレビューを表示
+        st.sidebar.image(preview_image, caption="プレビュー", use_container_width=True)
 
 # メイン部分
 st.markdown("## 🎨 あなただけのマーブル模様")
@@ -379,43 +475,77 @@ st.write(f"**現在の設定**: {preset if preset != 'カスタム設定' else '
 # 生成ボタン
 generate_col1, generate_col2 = st.columns([3, 1])
 if generate_col1.button("✨ マーブル模様を生成する ✨", use_container_width=True):
-    with st.spinner("模様を生成中... 少々お待ちください"):
-        # マーブル模様を生成
-        marble_image = create_enhanced_marble(
-            width=width,
-            height=height,
-            iterations=iterations,
-            speed=speed,
-            diffusion_rate=diffusion_rate,
-            viscosity=viscosity,
-            seed=seed,
-            colors=colors,
-            vortex_count=vortex_count,
-            vortex_strength=vortex_strength
-        )
-        
-        # 彩度とコントラストを強化
-        if enhance_colors:
-            # 彩度を上げる
-            enhancer = ImageEnhance.Color(marble_image)
-            marble_image = enhancer.enhance(saturation)
-            
-            # コントラストを上げる
-            enhancer = ImageEnhance.Contrast(marble_image)
-            marble_image = enhancer.enhance(contrast)
-        
-        # 画像を表示
-        st.image(marble_image, caption="あなたのマーブル模様", use_container_width=True)
-        
-        # ダウンロードボタン
-        buf = io.BytesIO()
-        marble_image.save(buf, format="PNG")
-        st.download_button(
-            label="画像をダウンロード",
-            data=buf.getvalue(),
-            file_name=f"marble_{palette_name}_{vortex_count}.png",
-            mime="image/png"
+    # 流れのパラメータが前回と同じ（かつシード固定）なら、シミュレーション結果を使い回す
+    if seed is None or st.session_state.get('marble_flow') != flow_params:
+        start_render(flow_params)
+
+# いろいろなシードの模様を小さく並べて、気に入ったものを選ぶ
+with st.expander("🎲 いろいろなシードを見比べる"):
+    if st.button(f"{GALLERY_SIZE} 個の模様を並べる"):
+        with st.spinner("模様を並べています..."):
+            gallery_seeds = [int(value) for value in np.random.default_rng().integers(0, 10001, GALLERY_SIZE)]
+            gallery_params = {name: value for name, value in flow_params.items() if name != "seed"}
+            # 本番と同じ大きさ・色素の数で初期状態を作り、シードごとに粗い格子で計算する（本番の縮小版になる）
+            _, gallery_images = create_marble_sweep(
+                gallery_seeds,
+                colors=colors,
+                pyramid=PREVIEW_PYRAMID,
+                num_dyes=NUM_DYES,
+                n_threads=RENDER_THREADS,
+                **gallery_params
+            )
+            st.session_state.gallery = list(zip(gallery_seeds, gallery_images))
+            st.session_state.gallery_flow = gallery_params
+    
+    if 'gallery' in st.session_state:
+        gallery_cols = st.columns(3)
+        for index, (gallery_seed, gallery_image) in enumerate(st.session_state.gallery):
+            col = gallery_cols[index % 3]
+            col.image(gallery_image, caption=f"シード {gallery_seed}", use_container_width=True)
+            if col.button("これにする", key=f"gallery_{index}"):
+                # 一覧を作ったときの設定のまま、選んだシードで本番の大きさの模様を生成する
+                start_render(dict(st.session_state.gallery_flow, seed=gallery_seed))
+
+# 生成中なら進み具合を表示し、終わったら結果を受け取る
+if 'render_job_id' in st.session_state:
+    show_render_progress()
+
+# 今の模様をそのまま続けて混ぜる（最初からやり直さない）
+if 'marble_simulation' in st.session_state:
+    if generate_col2.button("🌀 もっとまぜる", use_container_width=True):
+        with st.spinner("もう少しまぜています..."):
+            st.session_state.marble_simulation.step(EXTEND_ITERATIONS)
+            st.session_state.marble_render_id += 1
+
+if 'marble_simulation' in st.session_state:
+    # 色彩の強化前の画像は、模様か色が変わったときだけ合成し直す
+    # （彩度やコントラストのスライダーを動かしても、シミュレーションも合成もやり直さない）
+    raw_key = (st.session_state.marble_render_id, tuple(colors))
+    if st.session_state.get('marble_raw_key') != raw_key:
+        # パレットやカスタムカラーを変えても、色の合成だけをやり直す
+        st.session_state.marble_raw = st.session_state.marble_simulation.snapshot(
+            colors,
+            texture_seed=st.session_state.marble_texture_seed
         )
+        st.session_state.marble_raw_key = raw_key
+    marble_image = st.session_state.marble_raw
+    
+    # 彩度とコントラストを強化
+    if enhance_colors:
+        marble_image = enhance_marble(marble_image, saturation, contrast)
+    
+    # 画像を表示
+    st.image(marble_image, caption="あなたのマーブル模様", use_container_width=True)
+    
+    # ダウンロードボタン
+    buf = io.BytesIO()
+    marble_image.save(buf, format="PNG")
+    st.download_button(
+        label="画像をダウンロード",
+        data=buf.getvalue(),
+        file_name=f"marble_{palette_name}_{vortex_count}.png",
+        mime="image/png"
+    )
 else:
     # 初回表示時のガイダンス
     st.info("👆 上のボタンをクリックして、マーブル模様を生成してみましょう！")
@@ -424,6 +554,9 @@ else:
     - 左側の「かんたん設定」から好みのプリセットを選ぶと簡単です
     - 色や渦の数などを自分好みに調整したい場合は「詳細設定」を開きましょう
     - お子さんと一緒にいろいろな色や設定を試して、素敵な模様を作ってみましょう！
+    - 模様を作ったあとでパレットを変えると、同じ模様のまま色だけがすぐに変わります
+    - 「もっとまぜる」を押すと、今の模様をそのまま続けて混ぜられます
+    - 「彩度」や「コントラスト」は、生成し直さなくてもスライダーを動かすだけですぐに変わります
     """)
 
 # 使い方とヒント